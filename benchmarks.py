@@ -0,0 +1,338 @@
+#!/usr/bin/env python3.4
+# coding: utf-8
+
+"""Benchmarks for urlcleaner.
+
+sharding  - local cleaning throughput for different numbers of processes
+micro     - hot path micro-benchmarks: normalizers and URLStat creation
+e2e       - URLCleaner against a local mock of twitter and bit.ly, or of
+            linkedin and lnkd.in with --service linkedin
+
+"""
+
+import argparse
+import asyncio
+import itertools
+import logging
+import multiprocessing
+import random
+import resource
+import socket
+import time
+import timeit
+import zlib
+
+from cleanurls import ioreader, sharded_local_clean, clean_locally
+from urlcleaner import (URLCleaner, URLStat, HostScheduler, SHORTLINK_HOSTS,
+                        twitter_normalizer, linkedin_normalizer)
+
+SHORTENERS = ('bit.ly', 't.com', 'lnkd.in')
+
+# normalizer, shortener and profile url format of benchmarked services
+SERVICES = {
+    'twitter': (twitter_normalizer, 'bit.ly', 'twitter.com/{}'),
+    'linkedin': (linkedin_normalizer, 'lnkd.in', 'www.linkedin.com/in/{}'),
+}
+
+
+def as_linkedin(urls):
+    """Return linkedin profile urls with nicknames of twitter urls."""
+    profiles = []
+    for url in urls:
+        normalized = twitter_normalizer(url)
+        if normalized:
+            url = 'http://linkedin.com/in/' + normalized.rsplit('/', 1)[1]
+        profiles.append(url)
+    return profiles
+
+
+def corpus(path, size, shortlink_rate=0.0, seed=0, service='twitter'):
+    """Return size urls of service repeating urls from file at path.
+
+    The file holds twitter urls, they are turned into linkedin ones for
+    linkedin. shortlink_rate of urls are replaced by links of the
+    shortener of service.
+
+    """
+    with open(path, encoding='utf-8') as ioobj:
+        urls = list(ioreader(ioobj))
+    urls = list(itertools.islice(itertools.cycle(urls), size))
+    if service == 'linkedin':
+        urls = as_linkedin(urls)
+
+    _, shortener, _ = SERVICES[service]
+    rnd = random.Random(seed)
+    for index in range(len(urls)):
+        if rnd.random() < shortlink_rate:
+            urls[index] = 'http://{}/{:x}'.format(shortener,
+                                                  rnd.getrandbits(32))
+    return urls
+
+
+def bench_sharding(urls, procs_list, chunk_size):
+    """Measure local cleaning throughput for each number of processes."""
+    results = []
+    for procs in procs_list:
+        t0 = time.perf_counter()
+        if procs > 1:
+            count = sum(1 for _ in sharded_local_clean(urls, 'twitter', procs,
+                                                       chunk_size))
+        else:
+            cleaned = []
+            clean_locally(urls, twitter_normalizer, cleaned.append,
+                          chunk_size=chunk_size)
+            count = len(cleaned)
+        elapsed = time.perf_counter() - t0
+        results.append((procs, count, elapsed))
+
+    baseline = results[0][2]
+    for procs, count, elapsed in results:
+        print('procs={:<3} urls={} time={:.2f}s urls/s={:.0f} '
+              'speedup={:.2f}x'.format(procs, count, elapsed, count / elapsed,
+                                       baseline / elapsed))
+
+
+def bench_micro(urls, number):
+    """Print per call time of hot path functions."""
+    linkedin_urls = [
+        'http://ar.linkedin.com/in/ezequielcarlsson/',
+        'https://www.linkedin.com/pub/taylor-record/26/30a/a',
+        'http://@joaquingrech',
+        'http://www.linkedin.com/#!nikohrdy',
+        'http://www.linkedin.com/profile/view?id=85367361',
+    ]
+    cases = [
+        ('twitter_normalizer', lambda: [twitter_normalizer(url) for url in
+                                        urls], len(urls)),
+        ('linkedin_normalizer', lambda: [linkedin_normalizer(url) for url in
+                                         linkedin_urls], len(linkedin_urls)),
+        ('URLStat', lambda: URLStat(
+            url='@a', local_clean_url='https://twitter.com/a',
+            remote_clean_url=None, status='LOCAL_OK', http_code=None,
+            exception=None), 1),
+    ]
+    for name, func, calls in cases:
+        best = min(timeit.repeat(func, number=number, repeat=3))
+        print('{:<20} {:>8.0f} ns/call'.format(
+            name, best / number / calls * 1e9))
+
+
+class MockNormalizer:
+    """Normalizer routing normalized urls to a mock server.
+
+    https://twitter.com/nickname is turned into base/twitter.com/nickname
+    and back, so the wrapped normalizer sees the usual urls. Shortener
+    urls go to shortener_base, a host of its own, so that URLCleaner
+    expands them.
+
+    """
+    def __init__(self, normalizer, base, shortener_base=None):
+        self.normalizer = normalizer
+        self.base = base
+        self.shortener_base = shortener_base or base
+
+    def __call__(self, url):
+        if isinstance(url, str):
+            for base in (self.base, self.shortener_base):
+                if url.startswith(base + '/'):
+                    url = 'https://' + url[len(base) + 1:]
+                    break
+
+        normalized = self.normalizer(url)
+        if normalized:
+            path = normalized.split('://', 1)[1]
+            if path.partition('/')[0] in SHORTENERS:
+                return self.shortener_base + '/' + path
+            return self.base + '/' + path
+        return normalized
+
+
+def mock_app(base, latency, not_found_rate, throttle_rate, error_rate,
+             loop):
+    """Return aiohttp application simulating probed services.
+
+    lnkd.in links redirect to linkedin profiles, other shortener links to
+    twitter profiles. Profiles are found
+    unless their path hashes into not_found_rate. Every response is
+    delayed by about latency seconds and randomly throttled with 429 or
+    failed with 503.
+
+    """
+    from aiohttp import web
+
+    @asyncio.coroutine
+    def handle(request):
+        path = request.match_info['path']
+        yield from asyncio.sleep(latency * random.uniform(0.5, 1.5),
+                                 loop=loop)
+
+        chance = random.random()
+        if chance < throttle_rate:
+            return web.Response(status=429, headers={'RETRY-AFTER': '1'})
+        if chance < throttle_rate + error_rate:
+            return web.Response(status=503)
+
+        host, _, rest = path.partition('/')
+        checksum = zlib.crc32(rest.encode('utf-8'))
+        if host in SHORTENERS:
+            service = 'linkedin' if host == 'lnkd.in' else 'twitter'
+            _, _, profile = SERVICES[service]
+            location = '{}/{}'.format(base, profile.format(
+                'user{}'.format(checksum % 10000)))
+            return web.Response(status=301, headers={'LOCATION': location})
+        if checksum % 10000 < not_found_rate * 10000:
+            return web.Response(status=404)
+        return web.Response(status=200)
+
+    app = web.Application(loop=loop)
+    app.router.add_route('HEAD', '/{path:.*}', handle)
+    app.router.add_route('GET', '/{path:.*}', handle)
+    return app
+
+
+def serve_mock(ports, *args):
+    """Run mock server forever, target of the server process.
+
+    The first of ports serves profiles, the others the same application
+    as shortener hosts.
+
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    base = 'http://127.0.0.1:{}'.format(ports[0])
+    app = mock_app(base, *args, loop=loop)
+    handler = app.make_handler()
+    for port in ports:
+        loop.run_until_complete(
+            loop.create_server(handler, '127.0.0.1', port))
+    loop.run_forever()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def bench_e2e(urls, configs, arguments):
+    """Run URLCleaner against mock server for each (workers, connections)."""
+    port, shortener_port = free_port(), free_port()
+    base = 'http://127.0.0.1:{}'.format(port)
+    shortener_host = '127.0.0.1:{}'.format(shortener_port)
+    server = multiprocessing.Process(
+        target=serve_mock,
+        args=((port, shortener_port), arguments.latency,
+              arguments.not_found_rate, arguments.throttle_rate,
+              arguments.error_rate),
+        daemon=True)
+    server.start()
+    time.sleep(0.5)
+
+    try:
+        for num_workers, max_connections in configs:
+            loop = asyncio.new_event_loop()
+            statuses = {}
+
+            def result_saver(urlstat):
+                statuses[urlstat.status] = statuses.get(urlstat.status, 0) + 1
+
+            scheduler = HostScheduler(concurrency=max_connections,
+                                      rate=arguments.host_rate, loop=loop)
+            urlcleaner = URLCleaner(
+                urls, MockNormalizer(SERVICES[arguments.service][0], base,
+                                     'http://' + shortener_host),
+                result_saver=result_saver, num_workers=num_workers,
+                max_connections=max_connections, scheduler=scheduler,
+                timeout=arguments.timeout,
+                shortlink_hosts=SHORTLINK_HOSTS | {shortener_host},
+                loop=loop)
+
+            t0 = time.perf_counter()
+            try:
+                loop.run_until_complete(urlcleaner.clean())
+            except asyncio.CancelledError:
+                pass
+            elapsed = time.perf_counter() - t0
+            stats = urlcleaner.stats()
+            loop.close()
+
+            latency = stats['latency'].get('127.0.0.1:{}'.format(port), {})
+            print('workers={:<4} connections={:<4} urls={} time={:.2f}s '
+                  'urls/s={:.0f} p50={} p99={} maxrss={:.0f}MB {}'.format(
+                      num_workers, max_connections, stats['urls_out'],
+                      elapsed, stats['urls_out'] / elapsed,
+                      latency.get('p50'), latency.get('p99'),
+                      resource.getrusage(resource.RUSAGE_SELF).ru_maxrss /
+                      1024, ' '.join('{}={}'.format(status, count) for
+                                     status, count in sorted(
+                                         statuses.items()))))
+    finally:
+        server.terminate()
+        server.join()
+
+
+def config(value):
+    """Parse WORKERS:CONNECTIONS argument."""
+    workers, _, connections = value.partition(':')
+    return int(workers), int(connections or workers)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--corpus', help='file with urls',
+                        default='scoped_twitter_urls.txt')
+    subparsers = parser.add_subparsers(dest='benchmark')
+
+    sharding = subparsers.add_parser('sharding')
+    sharding.add_argument('-n', '--size', help='number of urls to clean',
+                          type=int, default=1000000)
+    sharding.add_argument('--procs', help='numbers of processes to compare',
+                          type=int, nargs='+', default=[1, 2, 4, 8])
+    sharding.add_argument('--chunk-size', help='urls per chunk',
+                          type=int, default=10000)
+
+    micro = subparsers.add_parser('micro')
+    micro.add_argument('-n', '--size', help='number of corpus urls',
+                       type=int, default=1000)
+    micro.add_argument('--number', help='timeit loops',
+                       type=int, default=100)
+
+    e2e = subparsers.add_parser('e2e')
+    e2e.add_argument('-n', '--size', help='number of urls to clean',
+                     type=int, default=5000)
+    e2e.add_argument('--configs', help='WORKERS:CONNECTIONS to compare',
+                     type=config, nargs='+',
+                     default=[(10, 30), (50, 50), (100, 100), (200, 200)])
+    e2e.add_argument('--service', help='service of urls and shortlinks',
+                     choices=sorted(SERVICES), default='twitter')
+    e2e.add_argument('--shortlink-rate', help='share of shortener urls',
+                     type=float, default=0.1)
+    e2e.add_argument('--latency', help='mean mock response latency',
+                     type=float, default=0.05)
+    e2e.add_argument('--not-found-rate', help='share of 404 responses',
+                     type=float, default=0.05)
+    e2e.add_argument('--throttle-rate', help='share of 429 responses',
+                     type=float, default=0.01)
+    e2e.add_argument('--error-rate', help='share of 503 responses',
+                     type=float, default=0.01)
+    e2e.add_argument('--host-rate', help='initial probes per second',
+                     type=float, default=10000.0)
+    e2e.add_argument('--timeout', help='probe timeout',
+                     type=float, default=3)
+
+    arguments = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    if arguments.benchmark == 'sharding':
+        bench_sharding(corpus(arguments.corpus, arguments.size),
+                       arguments.procs, arguments.chunk_size)
+    elif arguments.benchmark == 'micro':
+        bench_micro(corpus(arguments.corpus, arguments.size),
+                    arguments.number)
+    elif arguments.benchmark == 'e2e':
+        bench_e2e(corpus(arguments.corpus, arguments.size,
+                         arguments.shortlink_rate,
+                         service=arguments.service),
+                  arguments.configs, arguments)
+    else:
+        parser.print_help()
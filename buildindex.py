@@ -0,0 +1,90 @@
+#!/usr/bin/env python3.4
+# coding: utf-8
+
+"""Build indexes of known urls from cleanurls.py results."""
+
+import argparse
+import csv
+import gzip
+import json
+import logging
+
+from urlindex import write_index
+
+logger = logging.getLogger(__name__)
+
+OK_STATUSES = frozenset(('REMOTE_OK', 'KNOWN_OK'))
+INVALID_STATUSES = frozenset(('REMOTE_INVALID', 'KNOWN_INVALID'))
+
+
+def read_results(path):
+    """Yield result dicts from TSV or JSON Lines file, maybe gzipped."""
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', encoding='utf-8', newline='') as ioobj:
+        if '.jsonl' in path:
+            for line in ioobj:
+                if line.strip():
+                    yield json.loads(line)
+            return
+
+        for row in csv.DictReader(ioobj, delimiter='\t'):
+            yield row
+
+
+def collect(paths):
+    """Return known good and known invalid urls of results at paths.
+
+    Later results override earlier ones, so urls are in only one of them.
+
+    """
+    known_ok = {}
+    known_invalid = set()
+    for path in paths:
+        rows = 0
+        for row in read_results(path):
+            rows += 1
+            url = row.get('local_clean_url')
+            if not url:
+                continue
+            if row['status'] in OK_STATUSES:
+                known_invalid.discard(url)
+                http_code = row.get('http_code')
+                known_ok[url] = (int(http_code) if http_code else None,
+                                 row.get('remote_clean_url') or url)
+            elif row['status'] in INVALID_STATUSES:
+                known_ok.pop(url, None)
+                known_invalid.add(url)
+        logger.info('Read %d results from %s', rows, path)
+
+    return known_ok, known_invalid
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('results', help='cleanurls.py output files, TSV or '
+                        'JSON Lines, may be gzipped', nargs='+')
+    parser.add_argument('--known-ok', help='index file of verified urls',
+                        type=str, default=None)
+    parser.add_argument('--known-invalid', help='index file of invalid urls',
+                        type=str, default=None)
+    parser.add_argument('--false-positive-rate',
+                        help='Bloom filter false positive rate, they cost a '
+                        'binary search in the index', type=float,
+                        default=0.01)
+    arguments = parser.parse_args()
+    if not arguments.known_ok and not arguments.known_invalid:
+        parser.error('--known-ok or --known-invalid is required')
+
+    logging.basicConfig(level=logging.INFO)
+    known_ok, known_invalid = collect(arguments.results)
+
+    if arguments.known_ok:
+        write_index(arguments.known_ok, known_ok,
+                    arguments.false_positive_rate)
+        logger.info('Wrote %d known good urls to %s', len(known_ok),
+                    arguments.known_ok)
+    if arguments.known_invalid:
+        write_index(arguments.known_invalid, known_invalid,
+                    arguments.false_positive_rate)
+        logger.info('Wrote %d known invalid urls to %s', len(known_invalid),
+                    arguments.known_invalid)
@@ -5,90 +5,1164 @@
 
 import argparse
 import asyncio
+import cProfile
 import csv
+import gzip
+import importlib
+import io
+import itertools
+import json
 import logging
+import mmap
+import multiprocessing
+import os
+import queue
+import re
 import sys
+import time
+import zlib
 
-from signal import signal, SIGPIPE, SIG_DFL
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from signal import signal, SIGINT, SIGPIPE, SIGTERM, SIG_DFL, SIG_IGN
 
-from urlcleaner import URLCleaner, twitter_normalizer, linkedin_normalizer
+from urlcleaner import (URLCleaner, RemoteCache, SQLiteRemoteCache,
+                        HostScheduler, Backoff, RetryBudget, Journal, Status,
+                        ReorderBuffer, Autoscaler, ProbePolicy, NORMALIZERS,
+                        Dispatcher, MemoizedNormalizer, Profiler,
+                        NullProfiler, get_normalizer, local_clean_many,
+                        StopAsyncIteration)
+from urlindex import URLIndex
+from workqueue import LeasedURLs, SQLiteWorkQueue
 
 logger = logging.getLogger(__name__)
 signal(SIGPIPE, SIG_DFL)
 
 
-normalizer_map = {
-    'twitter': twitter_normalizer,
-    'linkedin': linkedin_normalizer,
-}
-
-
 def ioreader(ioobj):
     for line in ioobj:
         url = line.strip()
         yield url
 
 
-def iowriter(ioobj):
-    csvwriter = csv.writer(ioobj, delimiter='	')
-    ioobj.write('	'.join(('url', 'status', 'local_clean_url',
-                          'remote_clean_url', 'http_code', 'exception')))
-    ioobj.write('\n')
+_WHITESPACE = b' \t\r\x0b\x0c'
+_WHITESPACE_CHARS = [bytes((char,)) for char in _WHITESPACE]
+HEADER_LINES = frozenset((b'url', b'twitter_url', b'linkedin_url'))
+
+
+class URLReader:
+    """Iterate urls of a possibly huge or compressed file.
+
+    Plain files are memory mapped, gzip and zstd ones are decompressed as
+    a stream, both are split into lines on bytes block by block. Lines are
+    stripped of ASCII whitespace, blank and header lines are skipped.
+    prefilter, a bytes regular expression, drops lines not matching it
+    before they are decoded.
+
+    """
+    def __init__(self, path, prefilter=None, headers=HEADER_LINES,
+                 block_size=1 << 20):
+        self.path = path
+        self.search = prefilter.search if prefilter is not None else None
+        self.headers = headers
+        self._str_headers = frozenset(header.decode('utf-8') for header in
+                                      headers)
+        self.block_size = block_size
+
+        self.bytes = 0
+        self.lines = 0
+        self.urls = 0
+        self.skipped = 0
+        self.filtered = 0
+        self.elapsed = 0.0
+
+    def _open(self):
+        """Return binary file-like source and objects to close after."""
+        if self.path == '-':
+            return sys.stdin.buffer, []
+        if self.path.endswith('.gz'):
+            source = gzip.open(self.path, 'rb')
+            return source, [source]
+        if self.path.endswith('.zst'):
+            try:
+                import zstandard
+            except ImportError:
+                raise RuntimeError('zstandard package is required to read '
+                                   '%s' % self.path)
+            ioobj = open(self.path, 'rb')
+            source = zstandard.ZstdDecompressor().stream_reader(ioobj)
+            return source, [source, ioobj]
+
+        ioobj = open(self.path, 'rb')
+        if not os.fstat(ioobj.fileno()).st_size:
+            # empty files can't be mapped
+            return ioobj, [ioobj]
+        source = mmap.mmap(ioobj.fileno(), 0, access=mmap.ACCESS_READ)
+        return source, [source, ioobj]
+
+    def __iter__(self):
+        return itertools.chain.from_iterable(self.blocks())
+
+    def blocks(self):
+        """Yield lists of urls, one per block read."""
+        source, closeables = self._open()
+        clock = time.perf_counter
+        try:
+            tail = b''
+            while True:
+                # only reading and splitting is timed, not the consumer
+                t0 = clock()
+                block = source.read(self.block_size)
+                if not block:
+                    self.elapsed += clock() - t0
+                    break
+                self.bytes += len(block)
+                block = tail + block
+                end = block.rfind(b'\n')
+                if end < 0:
+                    tail = block
+                    self.elapsed += clock() - t0
+                    continue
+                tail = block[end + 1:]
+                urls = self._urls(block[:end])
+                self.elapsed += clock() - t0
+                yield urls
+            if tail:
+                t0 = clock()
+                urls = self._urls(tail)
+                self.elapsed += clock() - t0
+                yield urls
+        finally:
+            for closeable in closeables:
+                closeable.close()
+
+    def _urls(self, block):
+        """Return urls of block of complete lines."""
+        if self.search is None:
+            # nothing is dropped unread, decoding the block at once is faster
+            lines = block.decode('utf-8', 'replace').split('\n')
+            headers = self._str_headers
+            whitespace = _WHITESPACE.decode('ascii')
+        else:
+            lines = block.split(b'\n')
+            headers = self.headers
+            whitespace = _WHITESPACE
+        if any(char in block for char in _WHITESPACE_CHARS):
+            lines = [line.strip(whitespace) for line in lines]
+        urls = list(filter(None, lines))
+        if not headers.isdisjoint(urls):
+            urls = [url for url in urls if url not in headers]
+        self.lines += len(lines)
+        self.skipped += len(lines) - len(urls)
+
+        if self.search is not None:
+            matched = [url for url in urls if self.search(url)]
+            self.filtered += len(urls) - len(matched)
+            urls = [url.decode('utf-8', 'replace') for url in matched]
+
+        self.urls += len(urls)
+        return urls
+
+    def stats(self):
+        elapsed = max(self.elapsed, 1e-9)
+        return {
+            'bytes': self.bytes,
+            'lines': self.lines,
+            'urls': self.urls,
+            'skipped': self.skipped,
+            'filtered': self.filtered,
+            'elapsed': round(self.elapsed, 3),
+            'mb_per_second': round(self.bytes / elapsed / 1e6, 1),
+        }
+
+
+def host_limit(value):
+    """Parse HOST=CONCURRENCY[:RATE] argument."""
+    try:
+        host, limits = value.split('=', 1)
+        concurrency, _, rate = limits.partition(':')
+        limit = {'concurrency': int(concurrency)}
+        if rate:
+            limit['rate'] = float(rate)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            'expected HOST=CONCURRENCY[:RATE], got %r' % value)
+    return host.lower(), limit
+
+
+class ResultWriter:
+    """Buffered writer of URLStats to TSV or JSON Lines file.
+
+    Rows are accumulated and written when flush_rows rows are buffered or
+    flush_interval seconds passed since the last write. With loop they
+    are also written every flush_interval seconds while no rows come.
+    With executor writes are made in it and write() returns a future to
+    wait for.
+
+    """
+    fields = ('url', 'status', 'local_clean_url', 'remote_clean_url',
+              'http_code', 'exception', 'retries')
+
+    def __init__(self, ioobj, format='tsv', flush_rows=1000,
+                 flush_interval=1.0, header=True, executor=None, journal=None,
+                 loop=None):
+        self.ioobj = ioobj
+        self.format = format
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.executor = executor
+        self.journal = journal
+        self.loop = loop
+
+        self._buffer = io.StringIO()
+        self._buffered = 0
+        self._csvwriter = csv.writer(self._buffer, delimiter='	')
+
+        self.rows = 0
+        self.bytes = 0
+        self.t0 = self.flushed = time.time()
+        self._flusher = None
+        # write of the last periodic flush made in executor
+        self._pending = None
+        if loop is not None:
+            self._flusher = loop.call_later(flush_interval,
+                                            self._flush_periodically)
+
+        if header and format == 'tsv':
+            self._buffer.write('	'.join(self.fields))
+            self._buffer.write('\n')
+
+    def write(self, urlstat):
+        """Buffer urlstat, return future when buffer is flushed off-loop."""
+        if self.format == 'jsonl':
+            self._buffer.write(json.dumps({
+                'url': urlstat.url,
+                'status': str(urlstat.status),
+                'local_clean_url': urlstat.local_clean_url,
+                'remote_clean_url': urlstat.remote_clean_url,
+                'http_code': urlstat.http_code,
+                'exception': (str(urlstat.exception) if urlstat.exception
+                              is not None else None),
+                'retries': urlstat.retries,
+            }))
+            self._buffer.write('\n')
+        else:
+            self._csvwriter.writerow((
+                urlstat.url, urlstat.status, urlstat.local_clean_url,
+                urlstat.remote_clean_url, urlstat.http_code,
+                urlstat.exception, urlstat.retries
+            ))
+        self._buffered += 1
+
+        if (self._buffered >= self.flush_rows or
+                time.time() - self.flushed >= self.flush_interval):
+            return self.flush()
+
+    __call__ = write
+
+    def flush(self):
+        """Write buffered rows, off-loop if executor is set."""
+        data, records = self._take()
+        if self.executor is None:
+            self._write(data, records)
+            return None
+
+        loop = self.loop or asyncio.get_event_loop()
+        return loop.run_in_executor(self.executor, self._write, data, records)
+
+    def _take(self):
+        data = self._buffer.getvalue()
+        self.rows += self._buffered
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        self._buffered = 0
+        self.flushed = time.time()
+        records = self.journal.take() if self.journal is not None else b''
+        return data, records
+
+    def _flush_periodically(self):
+        # rows and journal records stay buffered during stalls otherwise
+        error = self._check_pending()
+        if error is not None:
+            logger.error('Writing results failed: %s', error)
+        if (self._pending is None and
+                time.time() - self.flushed >= self.flush_interval):
+            if self.executor is None:
+                self.flush()
+            else:
+                self._pending = self.executor.submit(self._write,
+                                                     *self._take())
+        self._flusher = self.loop.call_later(self.flush_interval,
+                                             self._flush_periodically)
+
+    def _check_pending(self, wait=False):
+        """Return error of the pending write once it is done."""
+        if self._pending is None or not (wait or self._pending.done()):
+            return None
+        error = self._pending.exception()
+        self._pending = None
+        return error
+
+    def close(self):
+        """Flush the rest of rows synchronously.
+
+        Raises error of a pending periodic write, rows would be lost.
+
+        """
+        if self._flusher is not None:
+            self._flusher.cancel()
+        if self.executor is not None:
+            # make sure rows are written in order
+            self.executor.shutdown(wait=True)
+        error = self._check_pending(wait=True)
+        if error is not None:
+            raise error
+        records = self.journal.take() if self.journal is not None else b''
+        self._write(self._buffer.getvalue(), records)
+        self.rows += self._buffered
+        self._buffered = 0
+        self.ioobj.flush()
+
+    def _write(self, data, records=b''):
+        if data:
+            self.ioobj.write(data)
+            self.bytes += len(data.encode('utf-8'))
+        if records:
+            self.ioobj.flush()
+            self.journal.write(records)
+
+    def stats(self):
+        elapsed = max(time.time() - self.t0, 1e-9)
+        return {
+            'rows': self.rows,
+            'bytes': self.bytes,
+            'rows_per_second': round(self.rows / elapsed, 1),
+            'bytes_per_second': round(self.bytes / elapsed, 1),
+        }
+
+
+class ServiceWriter:
+    """Writer of URLStats into a ResultWriter per service.
+
+    Service of url is found by dispatcher. path is formatted with the
+    service name, e.g. results.{service}.tsv, files are created on the
+    first url of their service.
+
+    """
+    def __init__(self, dispatcher, path, **writer_kwargs):
+        self.dispatcher = dispatcher
+        self.path = path
+        self.writer_kwargs = writer_kwargs
+        self.writers = OrderedDict()
+        self.statuses = {}
+
+    def write(self, urlstat):
+        service = self.dispatcher.service(urlstat.url)
+        writer = self.writers.get(service)
+        if writer is None:
+            ioobj = open(self.path.format(service=service), 'w',
+                         encoding='utf-8')
+            writer = self.writers[service] = ResultWriter(
+                ioobj, **self.writer_kwargs)
+            self.statuses[service] = Counter()
+        self.statuses[service][str(urlstat.status)] += 1
+        return writer.write(urlstat)
 
+    __call__ = write
+
+    def close(self):
+        for writer in self.writers.values():
+            writer.close()
+            writer.ioobj.close()
+
+    def stats(self):
+        return {service: dict(writer.stats(),
+                              statuses=dict(self.statuses[service]))
+                for service, writer in self.writers.items()}
+
+
+def chunked(iterable, size):
+    """Split iterable into lists of at most size items."""
+    iterator = iter(iterable)
     while True:
-        urlstat = (yield)
-        csvwriter.writerow((
-            urlstat.url, urlstat.status, urlstat.local_clean_url,
-            urlstat.remote_clean_url, urlstat.http_code, urlstat.exception
-        ))
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def numbered(urls, journal=None):
+    """Yield (seq, url) pairs of urls not completed in journal."""
+    for seq, url in enumerate(urls):
+        if journal is None or not journal.is_completed(seq):
+            yield seq, url
+
+
+def local_clean_numbered(numbered_urls, normalizer):
+    """Clean (seq, url) pairs locally, return list of URLStats."""
+    urlstats = local_clean_many([url for _, url in numbered_urls], normalizer)
+    for (seq, _), urlstat in zip(numbered_urls, urlstats):
+        urlstat.seq = seq
+    return urlstats
+
+
+def clean_locally(urls, normalizer, result_saver, chunk_size=10000,
+                  journal=None):
+    """Clean urls without remote probing and event loop."""
+    for chunk in chunked(numbered(urls, journal), chunk_size):
+        for urlstat in local_clean_numbered(chunk, normalizer):
+            result_saver(urlstat)
+            if journal is not None:
+                journal.record(urlstat.seq)
+
+
+# memoized normalizers of local cleaning processes, by service
+_chunk_normalizers = {}
+
+
+def _local_clean_chunk(service, chunk):
+    normalizer = _chunk_normalizers.get(service)
+    if normalizer is None:
+        normalizer = _chunk_normalizers[service] = MemoizedNormalizer(
+            get_normalizer(service))
+    return local_clean_numbered(chunk, normalizer)
+
+
+def sharded_local_clean(urls, service, procs, chunk_size=10000,
+                        journal=None):
+    """Clean urls locally in a pool of procs processes.
+
+    Yields URLStats in input order. At most two chunks per process are
+    in flight, so memory use doesn't depend on input size.
+
+    """
+    with multiprocessing.Pool(procs) as pool:
+        pending = deque()
+        for chunk in chunked(numbered(urls, journal), chunk_size):
+            pending.append(pool.apply_async(_local_clean_chunk,
+                                            (service, chunk)))
+            if len(pending) >= procs * 2:
+                yield from pending.popleft().get()
+
+        while pending:
+            yield from pending.popleft().get()
+
+
+def remote_candidates(urlstats, result_saver, journal=None):
+    """Save locally final URLStats and yield LOCAL_OK ones."""
+    for urlstat in urlstats:
+        if urlstat.status is Status.LOCAL_OK:
+            yield urlstat
+        else:
+            result_saver(urlstat)
+            if journal is not None:
+                journal.record(urlstat.seq)
+
+
+def report_stats(urlcleaner, interval):
+    """Log URLCleaner stats every interval seconds."""
+    logger.info('Stats: %s', json.dumps(urlcleaner.stats(), sort_keys=True))
+    urlcleaner.loop.call_later(interval, report_stats, urlcleaner, interval)
+
+
+def is_split_output(arguments):
+    """Return True if outfile is split per service."""
+    return bool(arguments.outfile) and '{service}' in arguments.outfile
+
+
+def validate_arguments(parser, arguments):
+    """Exit with parser error on incompatible arguments.
+
+    Plugins are imported first, so services they register are known.
+
+    """
+    if arguments.resume and not arguments.journal:
+        parser.error('--resume requires --journal')
+    if is_split_output(arguments) and arguments.journal:
+        parser.error('--journal is not supported with per-service outfile')
+    if arguments.work_queue and (arguments.journal or arguments.local_only or
+                                 arguments.probe_procs > 1):
+        parser.error('--work-queue is not supported with --journal, '
+                     '--local-only or --probe-procs')
+    if arguments.ordered and (arguments.journal or arguments.work_queue or
+                              arguments.probe_procs > 1):
+        parser.error('--ordered is not supported with --journal, '
+                     '--work-queue or --probe-procs')
+
+    for plugin in arguments.plugin:
+        importlib.import_module(plugin)
+    if arguments.service != 'all' and arguments.service not in NORMALIZERS:
+        parser.error('unknown service {}, registered are {}'.format(
+            arguments.service, ', '.join(NORMALIZERS)))
+
+
+def open_outfile(arguments):
+    """Return file results are written to and whether it needs a header.
+
+    It is None for outfile split per service, resumed runs append to it.
+
+    """
+    if is_split_output(arguments):
+        return None, True
+    if not arguments.outfile:
+        return sys.stdout, True
+    outfile = open(arguments.outfile, 'a' if arguments.resume else 'w',
+                   encoding='utf-8')
+    return outfile, not outfile.tell()
+
+
+def build_normalizer(arguments):
+    """Return normalizer of arguments.service, memoized unless disabled.
+
+    Results memoized in --normalizer-cache by previous runs are reused.
+
+    """
+    normalizer = get_normalizer(arguments.service)
+    if not arguments.normalizer_cache_size:
+        return normalizer
+
+    index = None
+    if arguments.normalizer_cache and os.path.exists(
+            arguments.normalizer_cache):
+        index = URLIndex(arguments.normalizer_cache)
+    return MemoizedNormalizer(normalizer,
+                              maxsize=arguments.normalizer_cache_size,
+                              index=index)
+
+
+def save_normalizer(arguments, normalizer):
+    """Save memoized results to --normalizer-cache for next runs."""
+    if not isinstance(normalizer, MemoizedNormalizer):
+        return
+    logger.info('Normalizer stats: %s', normalizer.stats())
+    if arguments.normalizer_cache:
+        normalizer.save(arguments.normalizer_cache)
+    if normalizer.index is not None:
+        normalizer.index.close()
+
+
+def build_urlcleaner(arguments, urls, normalizer, result_saver, journal=None,
+                     work_queue=None, profiler=None, loop=None):
+    """Return URLCleaner configured by command line arguments."""
+    if arguments.cache:
+        cache = SQLiteRemoteCache(arguments.cache,
+                                  maxsize=arguments.cache_size)
+    else:
+        cache = RemoteCache(maxsize=arguments.cache_size)
+
+    scheduler = HostScheduler(
+        concurrency=arguments.host_concurrency or arguments.max_connections,
+        rate=arguments.host_rate, host_limits=dict(arguments.host_limit),
+        loop=loop)
+    backoff = Backoff(base=arguments.backoff_base, cap=arguments.backoff_cap)
+    retry_budget = RetryBudget(ratio=arguments.retry_budget)
+    autoscaler = None
+    if arguments.autoscale:
+        autoscaler = Autoscaler(
+            min_workers=arguments.min_workers,
+            max_workers=arguments.max_workers or arguments.max_connections,
+            interval=arguments.autoscale_interval)
+
+    policy = None
+    if arguments.trust_local:
+        policy = ProbePolicy(sample_rate=arguments.sample_rate)
+
+    known_ok = known_invalid = None
+    if arguments.known_ok:
+        known_ok = URLIndex(arguments.known_ok)
+    if arguments.known_invalid:
+        known_invalid = URLIndex(arguments.known_invalid)
+
+    return URLCleaner(urls=urls,
+                      normalizer=normalizer,
+                      result_saver=result_saver,
+                      max_connections=arguments.max_connections,
+                      num_workers=arguments.workers, cache=cache,
+                      scheduler=scheduler, backoff=backoff,
+                      retry_budget=retry_budget, journal=journal,
+                      autoscaler=autoscaler,
+                      expand_shortlinks=not arguments.no_expand,
+                      verify_shortlinks=not arguments.trust_shortlinks,
+                      policy=policy, known_ok=known_ok,
+                      known_invalid=known_invalid,
+                      keepalive_timeout=arguments.keepalive_timeout,
+                      work_queue=work_queue,
+                      normalizer_cache_size=arguments.normalizer_cache_size,
+                      profiler=profiler,
+                      reorder_buffer=result_saver if arguments.ordered else
+                      None,
+                      loop=loop)
+
+
+def close_urlcleaner(urlcleaner):
+    """Close cache and indexes of URLCleaner built by build_urlcleaner."""
+    urlcleaner.cache.close()
+    for index in (urlcleaner.known_ok, urlcleaner.known_invalid):
+        if index is not None:
+            index.close()
+
+
+def dump_stats(arguments, stats):
+    logger.info('Stats: %s', json.dumps(stats, sort_keys=True))
+    if arguments.stats_json:
+        with open(arguments.stats_json, 'w', encoding='utf-8') as ioobj:
+            json.dump(stats, ioobj, indent=2, sort_keys=True)
+
+
+def clean_remotely(arguments, urls, normalizer, result_saver, journal=None,
+                   work_queue=None, profiler=None):
+    """Clean urls locally and remotely with URLCleaner.
+
+    With work_queue urls are leased from it instead.
+
+    """
+    event_loop = asyncio.get_event_loop()
+    if work_queue is not None:
+        urls = LeasedURLs(work_queue, normalizer,
+                          batch_size=arguments.lease_size, loop=event_loop)
+    urlcleaner = build_urlcleaner(arguments, urls, normalizer, result_saver,
+                                  journal, work_queue=work_queue,
+                                  profiler=profiler, loop=event_loop)
+
+    if arguments.stats_interval:
+        event_loop.call_later(arguments.stats_interval, report_stats,
+                              urlcleaner, arguments.stats_interval)
+
+    try:
+        event_loop.run_until_complete(urlcleaner.clean())
+    except KeyboardInterrupt:
+        logger.info("Caught keyboard interrupt. Canceling tasks...")
+        urlcleaner.cancel()
+        event_loop.run_forever()
+    except asyncio.futures.CancelledError:
+        pass
+    finally:
+        stats = urlcleaner.stats()
+        event_loop.close()
+        close_urlcleaner(urlcleaner)
+        dump_stats(arguments, stats)
+
+
+class ShardInput:
+    """Asynchronous iterator of URLStats sent to a probing process."""
+
+    def __init__(self, inq, loop):
+        self.inq = inq
+        self.loop = loop
+        self.urlstats = deque()
+
+    def __aiter__(self):
+        return self
+
+    @asyncio.coroutine
+    def __anext__(self):
+        while not self.urlstats:
+            try:
+                # with timeout, so the executor thread ends after cancel
+                batch = yield from self.loop.run_in_executor(
+                    None, self.inq.get, True, 0.5)
+            except queue.Empty:
+                continue
+            if batch is None:
+                raise StopAsyncIteration
+            self.urlstats.extend(batch)
+        return self.urlstats.popleft()
+
+
+class ShardOutput:
+    """Result saver sending URLStats of a probing process in batches."""
+
+    def __init__(self, outq, batch_size=100, interval=0.5, loop=None):
+        self.outq = outq
+        self.batch_size = batch_size
+        self.interval = interval
+        self.loop = loop
+        self.batch = []
+        if loop is not None:
+            loop.call_later(interval, self._flush_periodically)
+
+    def write(self, urlstat):
+        if urlstat.exception is not None:
+            # aiohttp exceptions can't be always unpickled
+            urlstat.exception = str(urlstat.exception)
+        self.batch.append(urlstat)
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    __call__ = write
+
+    def flush(self):
+        if self.batch:
+            self.outq.put(('results', self.batch))
+            self.batch = []
+
+    def _flush_periodically(self):
+        self.flush()
+        self.loop.call_later(self.interval, self._flush_periodically)
+
+
+def probe_shard(arguments, shard, inq, outq):
+    """Probe URLStats from inq, target of a probing process."""
+    # the supervisor handles keyboard interrupts and terminates us
+    signal(SIGINT, SIG_IGN)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    output = ShardOutput(outq, loop=loop)
+    normalizer = build_normalizer(arguments)
+    urlcleaner = build_urlcleaner(arguments, ShardInput(inq, loop),
+                                  normalizer, output,
+                                  profiler=(Profiler() if arguments.profile
+                                            else None), loop=loop)
+    loop.add_signal_handler(SIGTERM, urlcleaner.cancel)
+
+    try:
+        loop.run_until_complete(urlcleaner.clean())
+    except asyncio.CancelledError:
+        pass
+    finally:
+        output.flush()
+        outq.put(('done', shard, urlcleaner.stats()))
+        loop.close()
+        close_urlcleaner(urlcleaner)
+        if (isinstance(normalizer, MemoizedNormalizer) and
+                normalizer.index is not None):
+            normalizer.index.close()
+
+
+class ProbeSupervisor:
+    """Probe LOCAL_OK URLStats in processes with their own event loops.
+
+    URLStats are sharded by hash of local_clean_url, so probes of a url
+    are shared and cached in one process. Results of all processes are
+    saved by result_saver in this process.
+
+    """
+    def __init__(self, arguments, result_saver, journal=None,
+                 batch_size=100):
+        self.procs = arguments.probe_procs
+        self.result_saver = result_saver
+        self.journal = journal
+        self.batch_size = batch_size
+
+        self.outq = multiprocessing.Queue()
+        self.inqs = [multiprocessing.Queue(maxsize=10) for _ in
+                     range(self.procs)]
+        self.batches = [[] for _ in range(self.procs)]
+        self.processes = [
+            multiprocessing.Process(target=probe_shard, daemon=True,
+                                    args=(arguments, shard, inq, self.outq))
+            for shard, inq in enumerate(self.inqs)]
+        self.shard_stats = {}
+        self.local_statuses = Counter()
+
+    def run(self, urlstats):
+        for process in self.processes:
+            process.start()
+        try:
+            for urlstat in urlstats:
+                if urlstat.status is Status.LOCAL_OK:
+                    self.send(urlstat)
+                else:
+                    self.local_statuses[str(urlstat.status)] += 1
+                    self.save(urlstat)
+
+            for shard, batch in enumerate(self.batches):
+                if batch:
+                    self._put(shard, batch)
+                self._put(shard, None)
+            self.wait()
+        except KeyboardInterrupt:
+            logger.info('Caught keyboard interrupt. Stopping processes...')
+            for process in self.processes:
+                process.terminate()
+            self.wait()
+        finally:
+            for process in self.processes:
+                process.join()
+
+    def send(self, urlstat):
+        shard = zlib.crc32(urlstat.local_clean_url.encode('utf-8')) % (
+            self.procs)
+        batch = self.batches[shard]
+        batch.append(urlstat)
+        if len(batch) >= self.batch_size:
+            self._put(shard, batch)
+            self.batches[shard] = []
+
+    def _put(self, shard, batch):
+        while True:
+            try:
+                self.inqs[shard].put(batch, timeout=0.1)
+                return
+            except queue.Full:
+                # processes may wait for their results to be taken
+                self.receive()
+
+    def receive(self, timeout=0):
+        """Save results sent by processes, waiting up to timeout."""
+        try:
+            message = self.outq.get(timeout=timeout)
+            while True:
+                if message[0] == 'results':
+                    for urlstat in message[1]:
+                        self.save(urlstat)
+                else:
+                    _, shard, stats = message
+                    self.shard_stats[shard] = stats
+                message = self.outq.get_nowait()
+        except queue.Empty:
+            pass
+
+    def wait(self):
+        """Save results until all processes are done."""
+        while len(self.shard_stats) < self.procs:
+            if not any(process.is_alive() for process in self.processes):
+                # killed processes don't report
+                self.receive()
+                break
+            self.receive(timeout=0.1)
+
+    def save(self, urlstat):
+        self.result_saver(urlstat)
+        if self.journal is not None:
+            self.journal.record(urlstat.seq)
+
+    def stats(self):
+        shards = [self.shard_stats.get(shard) for shard in range(self.procs)]
+        reported = [stats for stats in shards if stats is not None]
+        statuses = Counter(self.local_statuses)
+        for stats in reported:
+            statuses.update(stats['statuses'])
+        merged = {key: sum(stats[key] for stats in reported) for key in
+                  ('urls_in', 'urls_out', 'out_per_second', 'retries',
+                   'deduplicated')}
+        merged.update({
+            'local': sum(self.local_statuses.values()),
+            'statuses': dict(statuses),
+            'shards': shards,
+        })
+        return merged
+
+
+def clean_supervised(arguments, urlstats, result_saver, journal=None):
+    """Probe locally cleaned urls in arguments.probe_procs processes."""
+    supervisor = ProbeSupervisor(arguments, result_saver, journal)
+    try:
+        supervisor.run(urlstats)
+    finally:
+        dump_stats(arguments, supervisor.stats())
+
+
+def clean_distributed(arguments, urls, normalizer, result_saver,
+                      profiler=None):
+    """Clean urls of a job shared with other nodes in --work-queue."""
+    work_queue = SQLiteWorkQueue(
+        arguments.work_queue, max_tries=arguments.max_leases,
+        visibility_timeout=arguments.visibility_timeout)
+    try:
+        # every node seeds the job, tasks already known are ignored
+        for chunk in chunked(enumerate(urls), arguments.chunk_size):
+            work_queue.put_many(chunk)
+        clean_remotely(arguments, (), normalizer, result_saver,
+                       work_queue=work_queue, profiler=profiler)
+    finally:
+        work_queue.close()
+
+
+def run(arguments, urls, normalizer, result_saver, journal=None,
+        profiler=None):
+    # URLCleaner profiles its own stages, these are the ones outside it
+    profiler = profiler or NullProfiler()
+    local_normalizer = profiler.wrap('local_clean', normalizer)
+    local_saver = profiler.wrap('save', result_saver)
+
+    if arguments.work_queue:
+        clean_distributed(arguments, urls, normalizer, result_saver,
+                          profiler=profiler)
+    elif arguments.probe_procs > 1 and not arguments.local_only:
+        if arguments.procs > 1:
+            urlstats = sharded_local_clean(
+                urls, arguments.service, arguments.procs,
+                arguments.chunk_size, journal=journal)
+        else:
+            urlstats = itertools.chain.from_iterable(
+                local_clean_numbered(chunk, local_normalizer) for chunk in
+                chunked(numbered(urls, journal), arguments.chunk_size))
+        clean_supervised(arguments, urlstats, local_saver, journal)
+    elif arguments.procs > 1:
+        urlstats = sharded_local_clean(urls, arguments.service,
+                                       arguments.procs, arguments.chunk_size,
+                                       journal=journal)
+        if arguments.local_only:
+            for urlstat in urlstats:
+                local_saver(urlstat)
+                if journal is not None:
+                    journal.record(urlstat.seq)
+        elif arguments.ordered:
+            # all urls pass URLCleaner, which waits for room in the buffer
+            clean_remotely(arguments, urlstats, normalizer, result_saver,
+                           profiler=profiler)
+        else:
+            clean_remotely(arguments,
+                           remote_candidates(urlstats, local_saver, journal),
+                           normalizer, result_saver, journal,
+                           profiler=profiler)
+    elif arguments.local_only:
+        clean_locally(urls, local_normalizer, local_saver,
+                      chunk_size=arguments.chunk_size, journal=journal)
+    else:
+        clean_remotely(arguments, urls, normalizer, result_saver, journal,
+                       profiler=profiler)
+
+
+def log_profile(profiler):
+    """Log time breakdown of stages, longest first."""
+    stats = profiler.stats()
+    stages = sorted(stats['stages'].items(), key=lambda item:
+                    item[1]['total'], reverse=True)
+    lines = ['{:<14}{:>10}{:>12}{:>12}{:>8}'.format(
+        'stage', 'count', 'total s', 'mean ms', 'share')]
+    for stage, stage_stats in stages:
+        lines.append('{:<14}{:>10}{:>12.3f}{:>12.3f}{:>7.0%}'.format(
+            stage, stage_stats['count'], stage_stats['total'],
+            stage_stats['mean_ms'],
+            stage_stats['total'] / max(stats['elapsed'], 1e-9)))
+    logger.info('Profile of %.3f seconds, concurrent stages overlap:\n%s',
+                stats['elapsed'], '\n'.join(lines))
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('infile', help='file with twitter urls',
-                        type=argparse.FileType('r', encoding='utf-8'))
-    parser.add_argument('outfile', help='output file name', nargs='?',
-                        type=argparse.FileType('w+', encoding='utf-8'),
-                        default=sys.stdout)
+    parser.add_argument('infile', help='file with urls, may be gzip or zstd '
+                        'compressed, - for standard input', type=str)
+    parser.add_argument('outfile', help='output file name, standard output '
+                        'if omitted', nargs='?', type=str, default=None)
+    parser.add_argument('--journal',
+                        help='file recording completed inputs for --resume',
+                        type=str, default=None)
+    parser.add_argument('--resume',
+                        help='skip inputs completed in --journal and append '
+                        'results to outfile', action='store_true')
+    parser.add_argument('--work-queue',
+                        help='SQLite work queue shared by nodes cleaning '
+                        'the same input, each node writes its results to '
+                        'its outfile, all are kept in the queue',
+                        type=str, default=None)
+    parser.add_argument('--lease-size',
+                        help='number of urls leased from --work-queue at once',
+                        type=int, default=100)
+    parser.add_argument('--visibility-timeout',
+                        help='seconds leases of a lost node block its urls',
+                        type=float, default=300.0)
+    parser.add_argument('--max-leases',
+                        help='number of leases before an unfinished url or '
+                        'one failing remotely is dead-lettered',
+                        type=int, default=3)
+    parser.add_argument('--normalizer-cache-size',
+                        help='number of memoized normalizer results, 0 '
+                        'disables memoization', type=int, default=100000)
+    parser.add_argument('--normalizer-cache',
+                        help='file memoized normalizer results are read '
+                        'from and saved to for next runs, rebuild it when '
+                        'normalizers change', type=str, default=None)
+    parser.add_argument('--prefilter',
+                        help='regular expression lines must match to be '
+                        'cleaned, others are dropped unread',
+                        type=lambda value: re.compile(value.encode('utf-8')),
+                        default=None)
+    parser.add_argument('-f', '--format', help='output format',
+                        type=str, choices=('tsv', 'jsonl'), default='tsv')
+    parser.add_argument('--flush-rows',
+                        help='number of buffered results written at once',
+                        type=int, default=1000)
+    parser.add_argument('--flush-interval',
+                        help='maximum seconds results stay buffered',
+                        type=float, default=1.0)
+    parser.add_argument('--ordered',
+                        help='write results in input order',
+                        action='store_true')
+    parser.add_argument('--reorder-capacity',
+                        help='maximum number of results held for --ordered',
+                        type=int, default=10000)
+    parser.add_argument('--stragglers',
+                        help='when --reorder-capacity is reached, block '
+                        'reading input or write DELAYED placeholders and '
+                        'late results after them',
+                        choices=ReorderBuffer.policies, default='block')
+    parser.add_argument('--writer-thread',
+                        help='write results in a separate thread',
+                        action='store_true')
     parser.add_argument('-s', '--service',
-                        help='what service urls are cleaned for',
-                        type=str, choices=('twitter', 'linkedin'),
-                        default='twitter')
+                        help='what service urls are cleaned for, e.g. '
+                        'twitter or linkedin, all routes every url to the '
+                        'service of its host', type=str, default='twitter')
+    parser.add_argument('--plugin',
+                        help='module registering more normalizers with '
+                        'register_normalizer, may be repeated',
+                        type=str, action='append', default=[])
     parser.add_argument('-w', '--workers', help='number of workers',
                         type=int, default=10)
     parser.add_argument('-c', '--max-connections',
                         help='maximum number of pool connections',
                         type=int, default=30)
+    parser.add_argument('--keepalive-timeout',
+                        help='seconds idle connections are kept for reuse',
+                        type=float, default=30)
+    parser.add_argument('--autoscale',
+                        help='adjust number of workers to throughput, '
+                        'starting from --workers',
+                        action='store_true')
+    parser.add_argument('--min-workers',
+                        help='minimum number of autoscaled workers',
+                        type=int, default=1)
+    parser.add_argument('--max-workers',
+                        help='maximum number of autoscaled workers, '
+                        'default is --max-connections',
+                        type=int, default=None)
+    parser.add_argument('--autoscale-interval',
+                        help='seconds between autoscaling decisions',
+                        type=float, default=1.0)
+    parser.add_argument('--no-expand',
+                        help='follow all redirects of short urls instead of '
+                        'stopping at the first profile url',
+                        action='store_true')
+    parser.add_argument('--trust-shortlinks',
+                        help='do not probe profiles short urls redirect to',
+                        action='store_true')
+    parser.add_argument('--trust-local',
+                        help='do not probe urls normalized to canonical '
+                        'profile urls, they get LOCAL_TRUSTED status',
+                        action='store_true')
+    parser.add_argument('--sample-rate',
+                        help='share of trusted urls probed anyway with '
+                        '--trust-local',
+                        type=float, default=0.0)
+    parser.add_argument('--known-ok',
+                        help='index of verified urls built by buildindex.py, '
+                        'they get KNOWN_OK status without probing',
+                        type=str, default=None)
+    parser.add_argument('--known-invalid',
+                        help='index of invalid urls built by buildindex.py, '
+                        'they get KNOWN_INVALID status without probing',
+                        type=str, default=None)
+    parser.add_argument('--local-only',
+                        help='only clean urls locally, without remote probing',
+                        action='store_true')
+    parser.add_argument('-p', '--procs',
+                        help='number of processes cleaning urls locally, '
+                        'with --local-only output keeps input order',
+                        type=int, default=1)
+    parser.add_argument('--probe-procs',
+                        help='number of processes probing urls, each with '
+                        'its own event loop and connections',
+                        type=int, default=1)
+    parser.add_argument('--chunk-size',
+                        help='number of urls cleaned locally in one batch',
+                        type=int, default=10000)
+    parser.add_argument('--host-concurrency',
+                        help='maximum number of concurrent probes per host, '
+                        'defaults to --max-connections',
+                        type=int, default=None)
+    parser.add_argument('--host-rate',
+                        help='initial probes per second per host, adapted '
+                        'when hosts throttle', type=float, default=100.0)
+    parser.add_argument('--host-limit', help='per-host limits as '
+                        'HOST=CONCURRENCY[:RATE], may be repeated',
+                        type=host_limit, action='append', default=[])
+    parser.add_argument('--backoff-base',
+                        help='seconds before the first retry, doubled for '
+                        'every next one', type=float, default=0.1)
+    parser.add_argument('--backoff-cap',
+                        help='maximum seconds between retries',
+                        type=float, default=10.0)
+    parser.add_argument('--retry-budget',
+                        help='maximum ratio of retries to first attempts '
+                        'in 10 seconds window', type=float, default=0.2)
+    parser.add_argument('--cache', help='SQLite file with cached remote '
+                        'cleaning results, in-memory cache is used if omitted',
+                        type=str, default=None)
+    parser.add_argument('--cache-size',
+                        help='maximum number of cached results kept in memory',
+                        type=int, default=100000)
+    parser.add_argument('--stats-interval',
+                        help='log run stats every given number of seconds',
+                        type=float, default=None)
+    parser.add_argument('--stats-json',
+                        help='file to dump final run stats as JSON',
+                        type=str, default=None)
+    parser.add_argument('--profile',
+                        help='log time spent in cleaning stages',
+                        action='store_true')
+    parser.add_argument('--profile-output',
+                        help='file to dump cProfile stats of the main '
+                        'process, e.g. for snakeviz or flameprof',
+                        type=str, default=None)
     parser.add_argument('-v', '--verbose', help='verbose output',
                         action='store_true')
 
     arguments = parser.parse_args()
+    validate_arguments(parser, arguments)
 
     loglevel = logging.DEBUG if arguments.verbose else logging.INFO
     logging.basicConfig(level=loglevel)
 
-    urls = ioreader(arguments.infile)
-    w = iowriter(arguments.outfile)
-    w.send(None)
+    journal = None
+    if arguments.journal:
+        journal = Journal(arguments.journal, resume=arguments.resume)
+        if arguments.resume:
+            logger.info('Resuming, %d urls are already completed',
+                        len(journal))
 
-    def result_saver(urlstat):
-        w.send(urlstat)
+    outfile, header = open_outfile(arguments)
 
-    event_loop = asyncio.get_event_loop()
-
-    urlcleaner = URLCleaner(urls=urls,
-                            normalizer=normalizer_map[arguments.service],
-                            result_saver=result_saver,
-                            max_connections=arguments.max_connections,
-                            num_workers=arguments.workers, loop=event_loop)
+    reader = URLReader(arguments.infile, prefilter=arguments.prefilter)
+    urls = iter(reader)
+    executor = None
+    if (arguments.writer_thread and not arguments.local_only and
+            arguments.probe_procs <= 1):
+        executor = ThreadPoolExecutor(max_workers=1)
+    writer_kwargs = {
+        'format': arguments.format,
+        'flush_rows': arguments.flush_rows,
+        'flush_interval': arguments.flush_interval,
+        'executor': executor,
+        'loop': None if arguments.local_only else asyncio.get_event_loop(),
+    }
+    if is_split_output(arguments):
+        writer = ServiceWriter(
+            Dispatcher() if arguments.service == 'all' else
+            Dispatcher([arguments.service]), arguments.outfile,
+            **writer_kwargs)
+    else:
+        writer = ResultWriter(outfile, header=header, journal=journal,
+                              **writer_kwargs)
+    result_saver = writer
+    if arguments.ordered:
+        result_saver = ReorderBuffer(writer,
+                                     capacity=arguments.reorder_capacity,
+                                     policy=arguments.stragglers)
 
+    normalizer = build_normalizer(arguments)
+    profiler = Profiler() if arguments.profile else NullProfiler()
+    urls = profiler.iterate('read', urls)
+    cprofile = None
+    if arguments.profile_output:
+        cprofile = cProfile.Profile()
+        cprofile.enable()
     try:
-        event_loop.run_until_complete(urlcleaner.clean())
-    except KeyboardInterrupt:
-        logger.info("Caught keyboard interrupt. Canceling tasks...")
-        urlcleaner.cancel()
-        event_loop.run_forever()
-    except asyncio.futures.CancelledError:
-        pass
+        run(arguments, urls, normalizer, result_saver, journal, profiler)
     finally:
-        event_loop.close()
+        if cprofile is not None:
+            cprofile.disable()
+            cprofile.dump_stats(arguments.profile_output)
+        if arguments.profile:
+            log_profile(profiler)
+        save_normalizer(arguments, normalizer)
+        if arguments.ordered:
+            result_saver.close()
+            logger.info('Reorder buffer stats: %s', result_saver.stats())
+        writer.close()
+        logger.info('Reader stats: %s', reader.stats())
+        logger.info('Result writer stats: %s', writer.stats())
+        if journal is not None:
+            journal.close()
@@ -5,12 +5,34 @@
 """Tests for urlcleaner"""
 
 import asyncio
+import gzip
+import io
+import json
 import logging
 import os
+import queue
+import re
+import sys
+import tempfile
+import time
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 
-from urlcleaner import (URLCleaner, URLStat, twitter_normalizer,
-                        linkedin_normalizer)
+from buildindex import collect
+from cleanurls import (ResultWriter, ServiceWriter, ShardInput, ShardOutput,
+                       URLReader)
+from urlcleaner import (URLCleaner, URLStat, Status, InvalidAttribute,
+                        RemoteCache, SQLiteRemoteCache, HostLimiter, Backoff,
+                        RetryBudget, parse_retry_after, Journal,
+                        LatencyHistogram, Autoscaler, ProbePolicy,
+                        ReorderBuffer, MemoizedNormalizer, Profiler,
+                        ConnectionStats, Dispatcher, NORMALIZERS,
+                        register_normalizer, local_clean_many,
+                        StopAsyncIteration,
+                        twitter_normalizer, linkedin_normalizer)
+import urlindex
+from urlindex import URLIndex, InvalidIndex, write_index
+from workqueue import LeasedURLs, SQLiteWorkQueue
 
 
 class TestURLCleaner(unittest.TestCase):
@@ -205,6 +227,1269 @@ class TestURLCleaner(unittest.TestCase):
         self.assertEqual(len(url_stat_apriori), num_of_successes)
 
 
+class TestNormalizers(unittest.TestCase):
+
+    def test_twitter(self):
+        cases = {
+            '@anilkirbas': 'https://twitter.com/anilkirbas',
+            'http://VIACONT': 'https://twitter.com/VIACONT',
+            'HTTP://WWW.Twitter.com/@atweed': 'https://twitter.com/atweed',
+            'http://twitter.com/atweed?lang=en': 'https://twitter.com/atweed',
+            'http://twitter.com/#!/kWhOURS': 'https://twitter.com/kWhOURS',
+            'http://bit.ly/18isnNg': 'http://bit.ly/18isnNg',
+            'ftp://twitter.com/atweed': False,
+            'http://twitter.com/atweed/': False,
+            'https://noname.noname': False,
+            None: False,
+        }
+        for url, normalized in cases.items():
+            self.assertEqual(normalized, twitter_normalizer(url), url)
+
+    def test_linkedin(self):
+        cases = {
+            'http://ar.linkedin.com/in/ezequielcarlsson/':
+            'https://www.linkedin.com/in/ezequielcarlsson',
+            'https://www.linkedin.com/in/@nikohrdy/details':
+            'https://www.linkedin.com/in/nikohrdy',
+            'http://www.linkedin.com/IN/nikohrdy':
+            'https://www.linkedin.com/in/IN',
+            'http://www.linkedin.com/#!nikohrdy':
+            'https://www.linkedin.com/in/nikohrdy',
+            'https://www.linkedin.com/pub/taylor-record/26/30a/a':
+            'https://www.linkedin.com/pub/taylor-record/26/30a/a',
+            'http://www.linkedin.com/profile/view?id=85367361': None,
+            'http://lnkd.in/abc': 'http://lnkd.in/abc',
+            'ftp://www.linkedin.com/in/nikohrdy': False,
+        }
+        for url, normalized in cases.items():
+            self.assertEqual(normalized, linkedin_normalizer(url), url)
+
+
+class TestDispatcher(unittest.TestCase):
+
+    def test_service(self):
+        dispatcher = Dispatcher()
+        for url, service in [
+                ('@nickname', 'twitter'),
+                ('http://twitter.com/nickname', 'twitter'),
+                ('https://ar.linkedin.com/in/nickname', 'linkedin'),
+                ('HTTP://user@LNKD.IN/abc', 'linkedin'),
+                ('http://bit.ly/abc', 'twitter'),
+                (None, 'twitter')]:
+            self.assertEqual(service, dispatcher.service(url), url)
+
+        self.assertEqual('linkedin', Dispatcher(
+            default='linkedin').service('http://bit.ly/abc'))
+
+    def test_registered_normalizer(self):
+        def github_normalizer(url):
+            return 'https://github.com/' + url.rstrip('/').rsplit('/', 1)[1]
+
+        register_normalizer('github', github_normalizer,
+                            hosts=['github.com'])
+        self.addCleanup(NORMALIZERS.pop, 'github')
+
+        dispatcher = Dispatcher()
+        self.assertEqual(['https://twitter.com/a',
+                          'https://www.linkedin.com/in/b',
+                          'https://github.com/c'],
+                         [dispatcher(url) for url in [
+                             '@a', 'http://www.linkedin.com/in/b',
+                             'http://www.github.com/c/']])
+
+    def test_service_writer(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        dispatcher = Dispatcher()
+        writer = ServiceWriter(dispatcher, os.path.join(
+            tmpdir.name, '{service}.tsv'), format='tsv')
+        for urlstat in local_clean_many(
+                ['@a', 'http://linkedin.com/in/b', '@c'], dispatcher):
+            writer(urlstat)
+        writer.close()
+
+        self.assertEqual(['linkedin.tsv', 'twitter.tsv'],
+                         sorted(os.listdir(tmpdir.name)))
+        stats = writer.stats()
+        self.assertEqual(2, stats['twitter']['rows'])
+        self.assertEqual({'LOCAL_OK': 1}, stats['linkedin']['statuses'])
+
+
+class TestLocalCleanMany(unittest.TestCase):
+
+    def test_local_clean_many(self):
+        urlstats = local_clean_many(
+            ['@anilkirbas', 'https://noname.noname',
+             'http://www.linkedin.com/profile/view?id=85367361'],
+            linkedin_normalizer)
+        self.assertEqual([
+            URLStat(url='@anilkirbas', status='LOCAL_INVALID'),
+            URLStat(url='https://noname.noname', status='LOCAL_INVALID'),
+            URLStat(url='http://www.linkedin.com/profile/view?id=85367361',
+                    status='UNCLEANED'),
+        ], urlstats)
+
+        urlstat, = local_clean_many(['@anilkirbas'], twitter_normalizer)
+        self.assertEqual(URLStat(
+            url='@anilkirbas', status='LOCAL_OK',
+            local_clean_url='https://twitter.com/anilkirbas'), urlstat)
+
+
+class TestMemoizedNormalizer(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+
+    def normalizer(self, url):
+        self.calls.append(url)
+        return twitter_normalizer(url)
+
+    def test_memoize(self):
+        normalizer = MemoizedNormalizer(self.normalizer, maxsize=2)
+        for url in ('@a', '@a', 'http://#bad', '@a', '@b', 'http://#bad',
+                    None):
+            self.assertEqual(twitter_normalizer(url), normalizer(url))
+        self.assertEqual(['@a', 'http://#bad', '@b', 'http://#bad', None],
+                         self.calls)
+        self.assertEqual({'size': 2, 'hits': 2, 'misses': 4,
+                          'index_hits': 0, 'hit_rate': 0.333},
+                         normalizer.stats())
+
+    def test_index(self):
+        urls = ['@a', 'http://#bad', 'http://twitter.com/', '@b']
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'normalizer.idx')
+            normalizer = MemoizedNormalizer(self.normalizer)
+            expected = [normalizer(url) for url in urls]
+            normalizer.save(path)
+
+            index = URLIndex(path)
+            self.addCleanup(index.close)
+            self.calls = []
+            normalizer = MemoizedNormalizer(self.normalizer, index=index)
+            self.assertEqual(expected, [normalizer(url) for url in urls])
+            self.assertEqual('@c', normalizer('@c') and self.calls[0])
+            self.assertEqual(4, normalizer.stats()['index_hits'])
+
+    def test_index_grows(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'normalizer.idx')
+            normalizer = MemoizedNormalizer(self.normalizer)
+            normalizer('@a')
+            normalizer('http://#bad')
+            normalizer.save(path)
+
+            # the next run neither uses nor keeps the saved results
+            index = URLIndex(path)
+            normalizer = MemoizedNormalizer(self.normalizer, maxsize=1,
+                                            index=index)
+            normalizer('@b')
+            normalizer('@c')
+            normalizer.save(path)
+            index.close()
+
+            index = URLIndex(path)
+            self.addCleanup(index.close)
+            self.assertEqual({
+                '@a': (None, 'https://twitter.com/a'),
+                'http://#bad': (MemoizedNormalizer._INVALID, ''),
+                '@c': (None, 'https://twitter.com/c'),
+            }, dict(index.items()))
+
+    def test_urlcleaner(self):
+        urlcleaner = URLCleaner([], self.normalizer,
+                                loop=asyncio.new_event_loop())
+        self.addCleanup(urlcleaner.loop.close)
+        urlcleaner.local_clean('@a')
+        urlcleaner.local_clean('@a')
+        self.assertEqual(['@a'], self.calls)
+        self.assertEqual(1, urlcleaner.stats()['normalizer']['hits'])
+
+
+class TestDeduplication(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(None)
+        self.addCleanup(self.loop.close)
+
+    def test_same_local_clean_url_probed_once(self):
+        probed = []
+
+        class CountingURLCleaner(URLCleaner):
+            @asyncio.coroutine
+            def remote_clean(self, urlstat):
+                probed.append(urlstat.local_clean_url)
+                yield from asyncio.sleep(0.01, loop=self.loop)
+                urlstat.http_code = 200
+                urlstat.status = 'REMOTE_OK'
+                urlstat.remote_clean_url = urlstat.local_clean_url
+                return urlstat
+
+        urls = ['@anilkirbas', 'http://twitter.com/anilkirbas',
+                'https://www.twitter.com/anilkirbas', '@atweed']
+        results = []
+        urlcleaner = CountingURLCleaner(
+            urls, normalizer=twitter_normalizer, result_saver=results.append,
+            num_workers=3, loop=self.loop)
+        self.loop.run_until_complete(urlcleaner.clean())
+
+        self.assertEqual(['https://twitter.com/anilkirbas',
+                          'https://twitter.com/atweed'], sorted(probed))
+        self.assertEqual(sorted(urls), sorted(r.url for r in results))
+        self.assertTrue(all(r.status is Status.REMOTE_OK for r in results))
+        self.assertEqual(2, urlcleaner.deduplicated)
+
+        stats = urlcleaner.stats()
+        self.assertEqual(4, stats['urls_in'])
+        self.assertEqual(4, stats['urls_out'])
+        self.assertEqual({'REMOTE_OK': 4}, stats['statuses'])
+
+    def test_cancelled_waiter(self):
+        class SlowURLCleaner(URLCleaner):
+            @asyncio.coroutine
+            def remote_clean(self, urlstat):
+                yield from asyncio.sleep(0.01, loop=self.loop)
+                urlstat.http_code = 200
+                urlstat.status = Status.REMOTE_OK
+                return urlstat
+
+        urlcleaner = SlowURLCleaner([], normalizer=twitter_normalizer,
+                                    loop=self.loop)
+        owner, cancelled, waiter = [
+            asyncio.Task(urlcleaner._shared_remote_clean(URLStat(
+                url='@a', local_clean_url='https://twitter.com/a')),
+                loop=self.loop) for _ in range(3)]
+        self.loop.run_until_complete(asyncio.sleep(0, loop=self.loop))
+        cancelled.cancel()
+        self.loop.run_until_complete(asyncio.wait([owner, cancelled, waiter],
+                                                  loop=self.loop))
+
+        self.assertTrue(cancelled.cancelled())
+        self.assertEqual(Status.REMOTE_OK, owner.result().status)
+        self.assertEqual(Status.REMOTE_OK, waiter.result().status)
+        self.assertEqual(2, urlcleaner.deduplicated)
+
+    def test_errors_not_replayed(self):
+        probed = []
+
+        class FailingURLCleaner(URLCleaner):
+            @asyncio.coroutine
+            def remote_clean(self, urlstat):
+                probed.append(urlstat.local_clean_url)
+                urlstat.status = 'REMOTE_ERROR'
+                return urlstat
+
+        urlcleaner = FailingURLCleaner(
+            ['@atweed', 'http://twitter.com/atweed'],
+            normalizer=twitter_normalizer, result_saver=lambda urlstat: None,
+            num_workers=1, loop=self.loop)
+        self.loop.run_until_complete(urlcleaner.clean())
+        self.assertEqual(['https://twitter.com/atweed'] * 2, probed)
+        self.assertEqual(0, urlcleaner.deduplicated)
+
+
+class TestConnectionStats(unittest.TestCase):
+
+    def test_opened_and_reused(self):
+        class Connector:
+            def __init__(self):
+                self._conns = {}
+
+            @asyncio.coroutine
+            def connect(self, req):
+                if self._conns.get(req):
+                    return self._conns[req].pop()
+                return (yield from self._create_connection(req))
+
+            @asyncio.coroutine
+            def _create_connection(self, req):
+                return req
+
+        class CountingConnector(ConnectionStats, Connector):
+            pass
+
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        connector = CountingConnector()
+        for _ in range(3):
+            connection = loop.run_until_complete(connector.connect('a'))
+            connector._conns.setdefault('a', []).append(connection)
+        self.assertEqual({'opened': 1, 'reused': 2, 'idle': 1},
+                         connector.connection_stats())
+
+
+class TestAutoscaler(unittest.TestCase):
+
+    def test_decide(self):
+        autoscaler = Autoscaler(2, 20, max_latency=1.0)
+        # backlog grows the pool
+        self.assertEqual(12, autoscaler.decide(10, 100, 0.8, 0, 0.1))
+        # throughput dropped after growth
+        self.assertEqual(10, autoscaler.decide(12, 50, 0.8, 0, 0.1))
+        # errors and latency shrink it
+        self.assertEqual(7, autoscaler.decide(10, 50, 0.8, 0.1, 0.1))
+        self.assertEqual(7, autoscaler.decide(10, 50, 0.8, 0, 2.0))
+        # idle pool shrinks slowly down to minimum
+        self.assertEqual(9, autoscaler.decide(10, 50, 0, 0, 0.1))
+        self.assertEqual(2, autoscaler.decide(2, 50, 0, 0, 0.1))
+        self.assertEqual(20, autoscaler.decide(20, 50, 1.0, 0, 0.1))
+
+    def test_clean_with_autoscaler(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+
+        class SlowURLCleaner(URLCleaner):
+            @asyncio.coroutine
+            def remote_clean(self, urlstat):
+                yield from asyncio.sleep(0.01, loop=self.loop)
+                urlstat.status = 'REMOTE_OK'
+                return urlstat
+
+        urls = ['@user{}'.format(i) for i in range(200)]
+        results = []
+        urlcleaner = SlowURLCleaner(
+            urls, normalizer=twitter_normalizer, result_saver=results.append,
+            num_workers=2, autoscaler=Autoscaler(1, 16, interval=0.02),
+            loop=loop)
+        loop.run_until_complete(urlcleaner.clean())
+
+        self.assertEqual(sorted(urls), sorted(r.url for r in results))
+        history = urlcleaner.stats()['concurrency_history']
+        self.assertEqual(2, history[0][1])
+        self.assertGreater(max(workers for _, workers in history), 2)
+
+
+class TestIterResults(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(None)
+        self.addCleanup(self.loop.close)
+
+    def collect(self, results):
+        @asyncio.coroutine
+        def consume():
+            urlstats = []
+            while True:
+                urlstat = yield from results.next()
+                if urlstat is None:
+                    return urlstats
+                urlstats.append(urlstat)
+        return self.loop.run_until_complete(consume())
+
+    def test_iter_results(self):
+        urls = ['foo bar', 'http://example.com/a'] * 50
+        urlcleaner = URLCleaner([], normalizer=twitter_normalizer,
+                                num_workers=2, qsize=4, result_qsize=4,
+                                loop=self.loop)
+        urlstats = self.collect(urlcleaner.iter_results(urls))
+
+        self.assertEqual(urls, [u.url for u in sorted(
+            urlstats, key=lambda u: u.seq)])
+        self.assertTrue(all(u.status is Status.LOCAL_INVALID for u in
+                            urlstats))
+        self.assertEqual(100, urlcleaner.stats()['urls_out'])
+
+    def test_saved_results_only(self):
+        reorder = ReorderBuffer(lambda urlstat: None, loop=self.loop)
+        urlcleaner = URLCleaner([], normalizer=twitter_normalizer,
+                                reorder_buffer=reorder, loop=self.loop)
+        self.addCleanup(urlcleaner.close)
+        self.assertRaises(ValueError, urlcleaner.iter_results, ['@a'])
+
+    def test_backpressure(self):
+        read = []
+
+        def urls():
+            for index in range(1000):
+                read.append(index)
+                yield 'foo{}'.format(index)
+
+        urlcleaner = URLCleaner([], normalizer=twitter_normalizer,
+                                num_workers=2, qsize=4, result_qsize=4,
+                                loop=self.loop)
+        results = urlcleaner.iter_results(urls())
+        self.loop.run_until_complete(results.next())
+        self.loop.run_until_complete(asyncio.sleep(0.01, loop=self.loop))
+        # queues and workers hold the rest
+        self.assertLess(len(read), 20)
+        results.close()
+        self.loop.run_until_complete(asyncio.sleep(0, loop=self.loop))
+
+    @unittest.skipIf(sys.version_info < (3, 5), 'no asynchronous iterators')
+    def test_async_iterable(self):
+        loop = self.loop
+
+        class AsyncURLs:
+            def __init__(self, urls):
+                self.urls = iter(urls)
+
+            def __aiter__(self):
+                return self
+
+            @asyncio.coroutine
+            def __anext__(self):
+                yield from asyncio.sleep(0, loop=loop)
+                try:
+                    return next(self.urls)
+                except StopIteration:
+                    raise StopAsyncIteration
+
+        urls = ['foo bar'] * 10
+        urlcleaner = URLCleaner([], normalizer=twitter_normalizer,
+                                loop=self.loop)
+        urlstats = self.collect(urlcleaner.iter_results(AsyncURLs(urls)))
+        self.assertEqual(list(range(10)), sorted(u.seq for u in urlstats))
+
+
+class FakeResponse:
+
+    def __init__(self, status, url, headers=None):
+        self.status = status
+        self.url = url
+        self.headers = headers or {}
+
+
+class TestShortlinks(unittest.TestCase):
+
+    routes = {
+        'http://bit.ly/a': (301, {'LOCATION': 'http://t.com/b'}),
+        'http://t.com/b': (302, {'LOCATION': 'https://twitter.com/user'}),
+        'http://bit.ly/gone': (404, {}),
+        'http://bit.ly/loop': (301, {'LOCATION': '/loop'}),
+        'http://sho.rt/c': (301, {'LOCATION': 'https://twitter.com/user'}),
+    }
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(None)
+        self.addCleanup(self.loop.close)
+
+    def clean(self, urls, normalizer=twitter_normalizer, **kwargs):
+        requests = []
+        routes = self.routes
+
+        class FakeURLCleaner(URLCleaner):
+            @asyncio.coroutine
+            def _head(self, urlstat, url, allow_redirects=True):
+                requests.append((url, allow_redirects))
+                status, headers = routes.get(url, (200, {}))
+                return FakeResponse(status, url, headers)
+
+        results = []
+        urlcleaner = FakeURLCleaner(
+            urls, normalizer=normalizer, result_saver=results.append,
+            loop=self.loop, **kwargs)
+        self.loop.run_until_complete(urlcleaner.clean())
+        return urlcleaner, {r.url: r for r in results}, requests
+
+    def test_expand(self):
+        _, results, requests = self.clean(
+            ['http://bit.ly/a', 'http://bit.ly/gone', 'http://bit.ly/loop',
+             '@user'])
+
+        self.assertEqual([('http://bit.ly/a', False),
+                          ('http://t.com/b', False),
+                          ('https://twitter.com/user', True)],
+                         [r for r in requests if 'gone' not in r[0] and
+                          'loop' not in r[0]])
+        self.assertEqual(Status.REMOTE_OK, results['http://bit.ly/a'].status)
+        self.assertEqual('https://twitter.com/user',
+                         results['http://bit.ly/a'].remote_clean_url)
+        self.assertEqual(200, results['http://bit.ly/a'].http_code)
+        self.assertEqual(Status.REMOTE_INVALID,
+                         results['http://bit.ly/gone'].status)
+        self.assertEqual(Status.REMOTE_ERROR,
+                         results['http://bit.ly/loop'].status)
+
+    def test_trusted_expansion_is_reused(self):
+        urlcleaner, results, requests = self.clean(
+            ['http://bit.ly/a', '@other', 'http://bit.ly/a'], dedup_size=1,
+            verify_shortlinks=False)
+
+        self.assertEqual(['http://bit.ly/a', 'http://t.com/b',
+                          'https://twitter.com/other'],
+                         [url for url, _ in requests])
+        self.assertEqual(1, urlcleaner.reused_expansions)
+        self.assertEqual(302, results['http://bit.ly/a'].http_code)
+        self.assertEqual('https://twitter.com/user',
+                         results['http://bit.ly/a'].remote_clean_url)
+
+    def test_shortlink_hosts(self):
+        _, results, requests = self.clean(
+            ['http://sho.rt/c'], normalizer=lambda url: url,
+            shortlink_hosts={'sho.rt'}, verify_shortlinks=False)
+
+        self.assertEqual([('http://sho.rt/c', False)], requests)
+        self.assertEqual('https://twitter.com/user',
+                         results['http://sho.rt/c'].remote_clean_url)
+
+
+class TestProbePolicy(unittest.TestCase):
+
+    def test_needs_probe(self):
+        policy = ProbePolicy()
+        for url, needs_probe in [
+                ('https://twitter.com/user', False),
+                ('https://www.linkedin.com/in/user', False),
+                ('http://bit.ly/abc', True),
+                ('https://www.linkedin.com/pub/user/26/30a/a', True)]:
+            urlstat = URLStat(url=url, local_clean_url=url,
+                              status=Status.LOCAL_OK)
+            self.assertEqual(needs_probe, policy.needs_probe(urlstat), url)
+
+    def test_sample_rate(self):
+        policy = ProbePolicy(sample_rate=0.1)
+        urlstats = [URLStat(local_clean_url='https://twitter.com/u{}'.format(
+            index)) for index in range(10000)]
+        sampled = [u for u in urlstats if policy.needs_probe(u)]
+        self.assertAlmostEqual(1000, len(sampled), delta=100)
+        # the same urls are sampled again
+        self.assertEqual(sampled, [u for u in sampled if
+                                   policy.needs_probe(u)])
+
+    def test_process_url(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        urlcleaner = URLCleaner([], normalizer=twitter_normalizer,
+                                policy=ProbePolicy(), loop=loop)
+        urlstat = loop.run_until_complete(urlcleaner.process_url('@user'))
+        self.assertIs(Status.LOCAL_TRUSTED, urlstat.status)
+        self.assertEqual({'trusted': 1, 'sampled': 0},
+                         urlcleaner.stats()['policy'])
+        urlcleaner.close()
+
+
+class TestHostLimiter(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(None)
+        self.addCleanup(self.loop.close)
+
+    def test_aimd(self):
+        limiter = HostLimiter(2, 10.0, increase=1.0, loop=self.loop)
+        self.loop.run_until_complete(limiter.acquire())
+        limiter.release(0.1)
+        self.assertAlmostEqual(10.1, limiter.rate)
+
+        # throttling is judged once the window is over
+        self.loop.run_until_complete(limiter.acquire())
+        limiter.release(0.1, throttled=True)
+        self.assertAlmostEqual(10.1, limiter.rate)
+        limiter.window_start -= 1
+        self.loop.run_until_complete(limiter.acquire())
+        limiter.release(3, throttled=True)
+        self.assertAlmostEqual(5.05, limiter.rate)
+        self.assertEqual(2, limiter.throttled)
+        self.assertAlmostEqual(5.05, limiter.burst)
+
+        # healthy responses increase the rate by about increase a second
+        for _ in range(5):
+            self.loop.run_until_complete(limiter.acquire())
+            limiter.release(0.1)
+        self.assertAlmostEqual(6.0, limiter.rate, places=1)
+        self.assertEqual(limiter.rate, limiter.burst)
+
+    def test_sporadic_errors(self):
+        limiter = HostLimiter(10, 5000.0, max_rate=1000.0, loop=self.loop)
+        self.assertEqual(1000.0, limiter.rate)
+        for request in range(1, 1001):
+            self.loop.run_until_complete(limiter.acquire())
+            limiter.release(0.1, throttled=request % 50 == 0)
+            if request % 100 == 0:
+                limiter.window_start -= 1
+        self.assertEqual(1000.0, limiter.rate)
+        self.assertEqual(20, limiter.throttled)
+
+    def test_rate_limit(self):
+        limiter = HostLimiter(10, 20.0, burst=1, loop=self.loop)
+
+        @asyncio.coroutine
+        def probe(times):
+            for _ in range(times):
+                yield from limiter.acquire()
+                limiter.release(10)
+
+        t0 = self.loop.time()
+        self.loop.run_until_complete(probe(5))
+        self.assertGreaterEqual(self.loop.time() - t0, 0.19)
+
+
+class TestRetries(unittest.TestCase):
+
+    def test_backoff(self):
+        backoff = Backoff(base=0.1, cap=1.0, jitter=False)
+        self.assertEqual([0.1, 0.2, 0.4, 0.8, 1.0],
+                         [backoff.delay(retry) for retry in range(1, 6)])
+        self.assertEqual(5, backoff.delay(1, retry_after=5))
+
+        backoff = Backoff(base=0.1)
+        self.assertTrue(0 <= backoff.delay(3) <= 0.4)
+
+    def test_retry_budget(self):
+        now = 0
+
+        budget = RetryBudget(ratio=0.5, window=10, min_retries=1,
+                             clock=lambda: now)
+        for _ in range(4):
+            budget.attempt()
+        self.assertTrue(budget.can_retry())
+        self.assertTrue(budget.can_retry())
+        self.assertFalse(budget.can_retry())
+
+        now = 11
+        self.assertTrue(budget.can_retry())
+        self.assertEqual(1, budget.rejected)
+
+    def test_parse_retry_after(self):
+        self.assertEqual(120, parse_retry_after('120'))
+        self.assertEqual(0, parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT'))
+        self.assertIsNone(parse_retry_after('soon'))
+        self.assertIsNone(parse_retry_after(None))
+
+    def test_retries_are_not_compared(self):
+        self.assertEqual(URLStat(url='@a', retries=2), URLStat(url='@a'))
+
+
+class TestURLStat(unittest.TestCase):
+
+    def test_status_is_interned(self):
+        urlstat = URLStat(url='@a', status='REMOTE_OK')
+        self.assertIs(Status.REMOTE_OK, urlstat.status)
+        self.assertEqual('REMOTE_OK', urlstat.status)
+        self.assertEqual('REMOTE_OK', str(urlstat.status))
+        self.assertIs(Status.UNCLEANED, URLStat().status)
+
+    def test_invalid_attribute(self):
+        with self.assertRaises(InvalidAttribute):
+            URLStat(url='@a', comment='invalid')
+        with self.assertRaises(AttributeError):
+            URLStat().comment = 'invalid'
+
+    def test_equality(self):
+        self.assertEqual(URLStat(url='@a', http_code=200),
+                         URLStat(url='@a', http_code=200))
+        self.assertNotEqual(URLStat(url='@a', http_code=200),
+                            URLStat(url='@a', http_code=404))
+
+
+class TestResultWriter(unittest.TestCase):
+
+    def test_tsv_batches(self):
+        ioobj = io.StringIO()
+        writer = ResultWriter(ioobj, flush_rows=2, flush_interval=60)
+        writer(URLStat(url='@a', status='LOCAL_OK',
+                       local_clean_url='https://twitter.com/a'))
+        self.assertEqual('', ioobj.getvalue())
+
+        writer(URLStat(url='@', status='LOCAL_INVALID'))
+        writer(URLStat(url='@b', status='REMOTE_ERROR',
+                       exception=ValueError('b')))
+        self.assertEqual(3, len(ioobj.getvalue().splitlines()))
+
+        writer.close()
+        lines = ioobj.getvalue().splitlines()
+        self.assertEqual('url\tstatus', lines[0][:10])
+        self.assertEqual('@b\tREMOTE_ERROR\t\t\t\tb\t0', lines[3])
+        self.assertEqual(3, writer.stats()['rows'])
+
+    def test_periodic_flush(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        ioobj = io.StringIO()
+        writer = ResultWriter(ioobj, flush_interval=0.01, header=False,
+                              loop=loop)
+        writer(URLStat(url='@a', status='LOCAL_INVALID'))
+        self.assertEqual('', ioobj.getvalue())
+        loop.run_until_complete(asyncio.sleep(0.05, loop=loop))
+        self.assertEqual(1, len(ioobj.getvalue().splitlines()))
+        writer.close()
+
+    def test_periodic_flush_error(self):
+        class FullIO(io.StringIO):
+            def write(self, data):
+                raise OSError('disk full')
+
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        writer = ResultWriter(FullIO(), flush_interval=0.01, header=False,
+                              executor=ThreadPoolExecutor(max_workers=1),
+                              loop=loop)
+        writer(URLStat(url='@a', status='LOCAL_INVALID'))
+        with self.assertLogs('cleanurls', logging.ERROR):
+            loop.run_until_complete(asyncio.sleep(0.05, loop=loop))
+
+        # a write still pending is waited for by close
+        writer(URLStat(url='@b', status='LOCAL_INVALID'))
+        writer.flushed -= 1
+        writer._flusher.cancel()
+        writer._flush_periodically()
+        self.assertRaises(OSError, writer.close)
+
+    def test_jsonl(self):
+        ioobj = io.StringIO()
+        writer = ResultWriter(ioobj, format='jsonl')
+        writer(URLStat(url='@b', status='REMOTE_ERROR',
+                       exception=ValueError('b')))
+        writer.close()
+        self.assertEqual({
+            'url': '@b', 'status': 'REMOTE_ERROR', 'local_clean_url': None,
+            'remote_clean_url': None, 'http_code': None, 'exception': 'b',
+            'retries': 0,
+        }, json.loads(ioobj.getvalue()))
+
+
+class TestURLReader(unittest.TestCase):
+
+    data = (b'twitter_url\n@user\n\n  http://twitter.com/other \n'
+            b'\xd0\xb6\n@last')
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+
+    def write(self, name, data, opener=open):
+        path = os.path.join(self.tmpdir.name, name)
+        with opener(path, 'wb') as ioobj:
+            ioobj.write(data)
+        return path
+
+    def test_read(self):
+        expected = ['@user', 'http://twitter.com/other', '\u0436', '@last']
+        for path in [self.write('urls.txt', self.data),
+                     self.write('urls.txt.gz', self.data, gzip.open)]:
+            reader = URLReader(path, block_size=4)
+            self.assertEqual(expected, list(reader))
+            stats = reader.stats()
+            self.assertEqual(len(self.data), stats['bytes'])
+            self.assertEqual(6, stats['lines'])
+            self.assertEqual(2, stats['skipped'])
+
+        self.assertEqual([], list(URLReader(self.write('empty.txt', b''))))
+
+    def test_prefilter(self):
+        reader = URLReader(self.write('urls.txt', self.data),
+                           prefilter=re.compile(b'^@'))
+        self.assertEqual(['@user', '@last'], list(reader))
+        self.assertEqual(2, reader.stats()['filtered'])
+
+    def test_elapsed_excludes_consumer(self):
+        reader = URLReader(self.write('urls.txt', self.data))
+        for url in reader:
+            time.sleep(0.05)
+        self.assertLess(reader.elapsed, 0.05)
+
+
+class TestShards(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+
+    def test_input(self):
+        inq = queue.Queue()
+        inq.put([URLStat(url='@a', seq=0), URLStat(url='@b', seq=1)])
+        inq.put([URLStat(url='@c', seq=2)])
+        inq.put(None)
+
+        @asyncio.coroutine
+        def read():
+            urls = []
+            shard_input = ShardInput(inq, self.loop).__aiter__()
+            while True:
+                try:
+                    urlstat = yield from shard_input.__anext__()
+                except StopAsyncIteration:
+                    return urls
+                urls.append(urlstat.url)
+
+        self.assertEqual(['@a', '@b', '@c'],
+                         self.loop.run_until_complete(read()))
+
+    def test_output(self):
+        outq = queue.Queue()
+        output = ShardOutput(outq, batch_size=2)
+        output(URLStat(url='@a', exception=ValueError('bad')))
+        self.assertTrue(outq.empty())
+        output(URLStat(url='@b'))
+        output(URLStat(url='@c'))
+        output.flush()
+        batches = [outq.get_nowait(), outq.get_nowait()]
+        self.assertEqual([['@a', '@b'], ['@c']],
+                         [[urlstat.url for urlstat in batch] for _, batch in
+                          batches])
+        self.assertEqual('bad', batches[0][1][0].exception)
+
+
+class TestURLIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+
+    def index(self, name, urls):
+        path = os.path.join(self.tmpdir.name, name)
+        write_index(path, urls)
+        index = URLIndex(path)
+        self.addCleanup(index.close)
+        return index
+
+    def test_set(self):
+        urls = ['https://twitter.com/u{}'.format(i) for i in range(1000)]
+        index = self.index('set.idx', urls)
+        self.assertEqual(1000, len(index))
+        self.assertTrue(all(url in index for url in urls))
+        self.assertFalse(any('https://twitter.com/x{}'.format(i) in index
+                             for i in range(1000)))
+        self.assertEqual((None, None), index.get(urls[0]))
+
+    def test_map(self):
+        index = self.index('map.idx', {
+            'https://twitter.com/a': (200, 'https://twitter.com/A'),
+            'https://twitter.com/b': (None, 'https://twitter.com/b'),
+        })
+        self.assertEqual((200, 'https://twitter.com/A'),
+                         index.get('https://twitter.com/a'))
+        self.assertEqual((None, 'https://twitter.com/b'),
+                         index.get('https://twitter.com/b'))
+        self.assertIsNone(index.get('https://twitter.com/c'))
+        self.assertEqual({'urls': 2, 'lookups': 3, 'hits': 2}, index.stats())
+
+    def test_hash_collisions(self):
+        # every url hashes the same, lookups compare the urls
+        original = urlindex.url_hashes
+        urlindex.url_hashes = lambda url: (1, 2)
+        self.addCleanup(setattr, urlindex, 'url_hashes', original)
+        index = self.index('collisions.idx', {
+            'https://twitter.com/a': (200, 'https://twitter.com/A'),
+            'https://twitter.com/b': (404, ''),
+        })
+        self.assertEqual((200, 'https://twitter.com/A'),
+                         index.get('https://twitter.com/a'))
+        self.assertEqual((404, ''), index.get('https://twitter.com/b'))
+        self.assertIsNone(index.get('https://twitter.com/c'))
+
+    def test_empty_and_invalid(self):
+        self.assertNotIn('@a', self.index('empty.idx', []))
+        path = os.path.join(self.tmpdir.name, 'invalid.idx')
+        with open(path, 'wb') as ioobj:
+            ioobj.write(b'not an index')
+        self.assertRaises(InvalidIndex, URLIndex, path)
+
+    def test_build_and_clean(self):
+        path = os.path.join(self.tmpdir.name, 'results.tsv')
+        with open(path, 'w', encoding='utf-8') as ioobj:
+            writer = ResultWriter(ioobj)
+            for url, status in [('a', 'REMOTE_OK'), ('b', 'REMOTE_INVALID'),
+                                ('c', 'REMOTE_OK'), ('c', 'REMOTE_INVALID'),
+                                ('d', 'REMOTE_ERROR')]:
+                writer(URLStat(url='@' + url, status=status,
+                               local_clean_url='https://twitter.com/' + url,
+                               remote_clean_url='https://twitter.com/' + url,
+                               http_code=200))
+            writer.close()
+
+        known_ok, known_invalid = collect([path])
+        self.assertEqual({'https://twitter.com/a':
+                          (200, 'https://twitter.com/a')}, known_ok)
+        self.assertEqual({'https://twitter.com/b', 'https://twitter.com/c'},
+                         known_invalid)
+
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        urlcleaner = URLCleaner(
+            [], normalizer=twitter_normalizer, loop=loop,
+            known_ok=self.index('ok.idx', known_ok),
+            known_invalid=self.index('invalid.idx', known_invalid))
+        self.addCleanup(urlcleaner.close)
+        statuses = [loop.run_until_complete(urlcleaner.process_url(url)).status
+                    for url in ['@a', 'http://twitter.com/b', '@c']]
+        self.assertEqual([Status.KNOWN_OK, Status.KNOWN_INVALID,
+                          Status.KNOWN_INVALID], statuses)
+
+
+class TestJournal(unittest.TestCase):
+
+    def test_resume(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'journal')
+            journal = Journal(path)
+            for seq in (0, 1, 3, 5):
+                journal.record(seq)
+            journal.flush()
+            journal.record(6)
+            journal.ioobj.close()
+
+            journal = Journal(path, resume=True)
+            self.assertEqual(2, journal.watermark)
+            self.assertEqual({3, 5}, journal.completed)
+            self.assertEqual([0, 1, 3, 5], [seq for seq in range(7) if
+                                            journal.is_completed(seq)])
+            journal.record(2)
+            journal.close()
+
+            journal = Journal(path, resume=True)
+            self.assertEqual(4, journal.watermark)
+            self.assertEqual(5, len(journal))
+            journal.close()
+
+            journal = Journal(path)
+            self.assertEqual(0, len(journal))
+            journal.close()
+
+
+class TestWorkQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.path = os.path.join(self.tmpdir.name, 'job.sqlite')
+        self.now = 0.0
+
+    def queue(self, owner):
+        work_queue = SQLiteWorkQueue(self.path, max_tries=2,
+                                     visibility_timeout=10, owner=owner,
+                                     clock=lambda: self.now)
+        self.addCleanup(work_queue.db.close)
+        return work_queue
+
+    def test_lease_ack(self):
+        node1, node2 = self.queue('node1'), self.queue('node2')
+        tasks = list(enumerate(['@a', '@b', '@c']))
+        node1.put_many(tasks)
+        node2.put_many(tasks)
+
+        self.assertEqual([(0, '@a'), (1, '@b')], node1.lease(2))
+        self.assertEqual([(2, '@c')], node2.lease(2))
+        self.assertEqual([], node2.lease(2))
+        self.assertFalse(node2.finished())
+
+        node1.ack(0, URLStat(url='@a', local_clean_url='https://twitter.com/a',
+                             status='REMOTE_OK', http_code=200))
+        node1.ack(1, URLStat(url='@b', status='REMOTE_ERROR',
+                             exception=ValueError('failed')))
+        node2.ack(2, URLStat(url='@c', status='LOCAL_INVALID'))
+        node1.flush()
+        node2.flush()
+        self.assertTrue(node1.finished())
+
+        results = list(node1.results())
+        self.assertEqual([0, 1, 2], [urlstat.seq for urlstat in results])
+        self.assertEqual(URLStat(url='@a',
+                                 local_clean_url='https://twitter.com/a',
+                                 status='REMOTE_OK', http_code=200),
+                         results[0])
+        self.assertEqual('failed', results[1].exception)
+        self.assertEqual(3, node1.stats()['done'])
+
+    def test_expired_leases(self):
+        node1, node2 = self.queue('node1'), self.queue('node2')
+        node1.put_many([(0, '@a'), (1, '@b')])
+        self.assertEqual(2, len(node1.lease(10)))
+
+        # node1 is lost, node2 takes over after visibility timeout
+        self.assertEqual([], node2.lease(10))
+        self.now = 10
+        self.assertEqual([(0, '@a'), (1, '@b')], node2.lease(10))
+        node2.ack(0, URLStat(url='@a', status='LOCAL_TRUSTED'))
+        node2.flush()
+
+        self.now = 20
+        self.assertEqual([], node1.lease(10))
+        self.assertEqual([(1, '@b', 2, 'lease expired')],
+                         list(node1.dead_letters()))
+        self.assertEqual(1, node1.stats()['dead'])
+        self.assertTrue(node1.finished())
+
+    def test_fail_and_close(self):
+        node = self.queue('node')
+        node.put_many([(0, '@a'), (1, '@b')])
+        node.lease(1)
+        node.fail(0, 'saving failed')
+        self.assertEqual([(0, '@a')], node.lease(1))
+        node.fail(0, 'saving failed')
+        self.assertEqual([(0, '@a', 2, 'saving failed')],
+                         list(node.dead_letters()))
+
+        node.lease(1)
+        node.close()
+        node = self.queue('other')
+        self.assertEqual({'pending': 1, 'leased': 0, 'done': 0, 'dead': 1},
+                         {state: count for state, count in
+                          node.stats().items() if state in
+                          ('pending', 'leased', 'done', 'dead')})
+        self.assertEqual([(1, '@b')], node.lease(1))
+
+    def test_leased_urls(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        node = self.queue('node')
+        node.put_many(enumerate(['@a', 'http://#bad']))
+        leased = LeasedURLs(node, twitter_normalizer, batch_size=1,
+                            loop=loop).__aiter__()
+
+        @asyncio.coroutine
+        def read():
+            urlstats = []
+            while True:
+                try:
+                    urlstat = yield from leased.__anext__()
+                except StopAsyncIteration:
+                    return urlstats
+                urlstats.append(urlstat)
+                node.ack(urlstat.seq, urlstat)
+
+        urlstats = loop.run_until_complete(read())
+        self.assertEqual([(0, 'LOCAL_OK'), (1, 'LOCAL_INVALID')],
+                         [(urlstat.seq, str(urlstat.status)) for urlstat in
+                          urlstats])
+
+    def clean_failing(self, **kwargs):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        node = self.queue('node')
+        node.put_many(enumerate(['@a', '@b']))
+        probed = []
+
+        class FailingURLCleaner(URLCleaner):
+            @asyncio.coroutine
+            def remote_clean(self, urlstat):
+                probed.append(urlstat.url)
+                if urlstat.url == '@b':
+                    urlstat.status = Status.REMOTE_ERROR
+                    urlstat.exception = ValueError('timeout')
+                else:
+                    urlstat.status = Status.REMOTE_OK
+                return urlstat
+
+        results = []
+        urlcleaner = FailingURLCleaner(
+            LeasedURLs(node, twitter_normalizer, poll_interval=0.01,
+                       loop=loop),
+            normalizer=twitter_normalizer, result_saver=results.append,
+            work_queue=node, loop=loop, **kwargs)
+        loop.run_until_complete(urlcleaner.clean())
+        return node, results, probed
+
+    def test_remote_errors_retried(self):
+        node, results, probed = self.clean_failing()
+        self.assertEqual(['@a'], [urlstat.url for urlstat in results])
+        self.assertEqual(['@a', '@b', '@b'], probed)
+        self.assertEqual([(1, '@b', 2, 'timeout')], list(node.dead_letters()))
+
+    def test_remote_errors_not_cached(self):
+        cache = RemoteCache()
+        # e.g. cached by a previous run
+        cache.set('https://twitter.com/b', None, 'REMOTE_ERROR', None)
+        node, results, probed = self.clean_failing(cache=cache)
+        self.assertEqual(['@a', '@b', '@b'], probed)
+        self.assertEqual([(1, '@b', 2, 'timeout')], list(node.dead_letters()))
+        self.assertEqual('REMOTE_OK', cache.get('https://twitter.com/a')[1])
+
+
+class TestReorderBuffer(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        self.saved = []
+
+    def urlstat(self, seq):
+        return URLStat(url='@{}'.format(seq), status='LOCAL_OK', seq=seq)
+
+    def saved_seqs(self):
+        return [(urlstat.seq, str(urlstat.status)) for urlstat in self.saved]
+
+    def test_order(self):
+        reorder = ReorderBuffer(self.saved.append, loop=self.loop)
+        for seq in (2, 0, 3, 1, 5):
+            reorder(self.urlstat(seq))
+        self.assertEqual([0, 1, 2, 3], [urlstat.seq for urlstat in
+                                        self.saved])
+        self.assertEqual(2, reorder.stats()['max_held'])
+        reorder.close()
+        self.assertEqual([0, 1, 2, 3, 5], [urlstat.seq for urlstat in
+                                           self.saved])
+
+    def test_block(self):
+        reorder = ReorderBuffer(self.saved.append, capacity=2,
+                                loop=self.loop)
+        self.loop.run_until_complete(reorder.expect(1, '@1'))
+        waiting = asyncio.Task(reorder.expect(2, '@2'), loop=self.loop)
+        self.loop.run_until_complete(asyncio.sleep(0, loop=self.loop))
+        self.assertFalse(waiting.done())
+
+        reorder(self.urlstat(1))
+        reorder(self.urlstat(0))
+        self.loop.run_until_complete(waiting)
+        self.assertEqual(1, reorder.stats()['blocked'])
+
+    def test_placeholder(self):
+        reorder = ReorderBuffer(self.saved.append, capacity=2,
+                                policy='placeholder', loop=self.loop)
+        for seq in range(5):
+            self.loop.run_until_complete(reorder.expect(seq,
+                                                        '@{}'.format(seq)))
+        for seq in (1, 2, 3, 0, 4):
+            reorder(self.urlstat(seq))
+        self.assertEqual([(0, 'DELAYED'), (1, 'LOCAL_OK'), (2, 'LOCAL_OK'),
+                          (3, 'LOCAL_OK'), (0, 'LOCAL_OK'), (4, 'LOCAL_OK')],
+                         self.saved_seqs())
+        self.assertEqual('@0', self.saved[0].url)
+        self.assertEqual({'held': 0, 'max_held': 2, 'blocked': 0,
+                          'placeholders': 1, 'patched': 1}, reorder.stats())
+
+    def test_saver_error(self):
+        def result_saver(urlstat):
+            if urlstat.seq == 1:
+                raise ValueError('disk full')
+            self.saved.append(urlstat)
+
+        reorder = ReorderBuffer(result_saver, capacity=2, loop=self.loop)
+        reorder(self.urlstat(2))
+        reorder(self.urlstat(1))
+        with self.assertRaises(ValueError):
+            reorder(self.urlstat(0))
+        self.assertEqual(2, reorder.next_seq)
+
+        # inputs are not blocked by the lost row
+        self.loop.run_until_complete(reorder.expect(3, '@3'))
+        reorder(self.urlstat(3))
+        self.assertEqual([0, 2, 3], [urlstat.seq for urlstat in self.saved])
+
+
+class TestLatencyHistogram(unittest.TestCase):
+
+    def test_percentiles(self):
+        histogram = LatencyHistogram(min_latency=0.01, max_latency=10,
+                                     factor=2)
+        self.assertIsNone(histogram.percentile(50))
+        for latency in [0.015] * 90 + [0.5] * 9 + [20]:
+            histogram.observe(latency)
+
+        self.assertEqual(0.02, histogram.percentile(50))
+        self.assertEqual(0.02, histogram.percentile(90))
+        self.assertEqual(0.64, histogram.percentile(99))
+        self.assertEqual(20, histogram.percentile(100))
+        self.assertEqual(100, histogram.stats()['count'])
+
+
+class TestProfiler(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0.0
+        self.profiler = Profiler(clock=lambda: self.now)
+
+    def tick(self, *args):
+        self.now += 0.5
+        return args
+
+    def test_stages(self):
+        spans = []
+        self.profiler.add_hook(lambda *span: spans.append(span))
+        urls = list(self.profiler.iterate('read', self.tick('@a', '@b')))
+        self.assertEqual(['@a', '@b'], urls)
+        self.assertEqual(('@a',), self.profiler.wrap('save', self.tick)('@a'))
+        self.profiler.record('request', 1.0, 0.25)
+        with self.assertRaises(ValueError):
+            with self.profiler.stage('save'):
+                raise ValueError
+
+        self.assertEqual([('read', 0.5, 0.0), ('read', 0.5, 0.0),
+                          ('save', 0.5, 0.5), ('request', 1.0, 0.25),
+                          ('save', 1.0, 0.0)], spans)
+        self.assertEqual({
+            'elapsed': 1.0,
+            'stages': {
+                'read': {'count': 2, 'total': 0.0, 'mean_ms': 0.0},
+                'save': {'count': 2, 'total': 0.5, 'mean_ms': 250.0},
+                'request': {'count': 1, 'total': 0.25, 'mean_ms': 250.0},
+            },
+        }, self.profiler.stats())
+
+    def test_urlcleaner(self):
+        urlcleaner = URLCleaner([], twitter_normalizer,
+                                profiler=self.profiler,
+                                loop=asyncio.new_event_loop())
+        self.addCleanup(urlcleaner.loop.close)
+        urlcleaner.local_clean('@a')
+        self.assertEqual(1, self.profiler.counts['local_clean'])
+        self.assertIs(self.profiler, urlcleaner.connector.profiler)
+        self.assertIn('profile', urlcleaner.stats())
+
+        urlcleaner = URLCleaner([], twitter_normalizer,
+                                loop=urlcleaner.loop)
+        self.assertEqual(Status.LOCAL_OK,
+                         urlcleaner.local_clean('@a').status)
+        self.assertNotIn('profile', urlcleaner.stats())
+
+
+class TestRemoteCache(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+
+    def clock(self):
+        return self.now
+
+    def test_lru_eviction(self):
+        cache = RemoteCache(maxsize=2, clock=self.clock)
+        cache.set('a', 200, 'REMOTE_OK', 'https://twitter.com/a')
+        cache.set('b', 200, 'REMOTE_OK', 'https://twitter.com/b')
+        self.assertIsNotNone(cache.get('a'))
+        cache.set('c', 404, 'REMOTE_INVALID', None)
+
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual((200, 'REMOTE_OK', 'https://twitter.com/a'),
+                         cache.get('a'))
+        self.assertEqual((404, 'REMOTE_INVALID', None), cache.get('c'))
+        self.assertEqual(1, cache.evictions)
+        self.assertEqual(3, cache.hits)
+        self.assertEqual(1, cache.misses)
+
+    def test_ttl_per_status(self):
+        cache = RemoteCache(ttls={'REMOTE_ERROR': 10}, clock=self.clock)
+        cache.set('ok', 200, 'REMOTE_OK', 'https://twitter.com/ok')
+        cache.set('error', None, 'REMOTE_ERROR', None)
+        self.now += 11
+
+        self.assertIsNone(cache.get('error'))
+        self.assertIsNotNone(cache.get('ok'))
+        self.assertEqual(1, cache.expirations)
+
+    def test_sqlite_persistence(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'cache.sqlite')
+            cache = SQLiteRemoteCache(path, clock=self.clock)
+            cache.set('a', 200, 'REMOTE_OK', 'https://twitter.com/a')
+            cache.close()
+
+            cache = SQLiteRemoteCache(path, clock=self.clock)
+            self.assertEqual((200, 'REMOTE_OK', 'https://twitter.com/a'),
+                             cache.get('a'))
+            cache.close()
+
+    def test_sqlite_shared(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'cache.sqlite')
+            writer = SQLiteRemoteCache(path, timeout=0.01, clock=self.clock)
+            reader = SQLiteRemoteCache(path, timeout=0.01, clock=self.clock)
+            writer.set('a', 200, 'REMOTE_OK', 'https://twitter.com/a')
+            self.assertEqual((200, 'REMOTE_OK', 'https://twitter.com/a'),
+                             reader.get('a'))
+
+            # writes failing on a busy database are kept in memory
+            reader.db.execute('BEGIN IMMEDIATE')
+            writer.set('b', 404, 'REMOTE_INVALID', None)
+            reader.db.rollback()
+            self.assertEqual((404, 'REMOTE_INVALID', None), writer.get('b'))
+            self.assertIsNone(reader.get('b'))
+            writer.close()
+            reader.close()
+
+
 if __name__ == '__main__':
     os.environ.setdefault('PYTHONASYNCIODEBUG', '1')
     loglevel = os.environ.get('LOGLEVEL', 'DEBUG')
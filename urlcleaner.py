@@ -6,12 +6,24 @@
 
 import asyncio
 import aiohttp
+import bisect
+import email.utils
 import logging
 import os
+import random
 import re
+import sqlite3
+import struct
 import time
+import zlib
 
-from urllib.parse import urlparse, urlunparse
+from collections import Counter, OrderedDict, deque
+from contextlib import contextmanager
+from enum import Enum
+from operator import attrgetter
+from urllib.parse import urljoin, urlparse
+
+from urlindex import write_index
 
 try:
     # Python <3.4.4.
@@ -20,6 +32,13 @@ except ImportError:
     # Python >=3.4.4.
     from asyncio import Queue
 
+try:
+    StopAsyncIteration = StopAsyncIteration
+except NameError:
+    # Python <3.5, raised by asynchronous iterators written for URLCleaner.
+    class StopAsyncIteration(Exception):
+        pass
+
 
 logger = logging.getLogger(__name__)
 
@@ -28,116 +47,1200 @@ class InvalidAttribute(Exception):
     pass
 
 
-class URLStat:
+class Status(str, Enum):
+    """URL cleaning status."""
 
-    url = None
-    local_clean_url = None
-    remote_clean_url = None
-    status = 'UNCLEANED'
-    http_code = None
-    exception = None
+    UNCLEANED = 'UNCLEANED'
+    LOCAL_OK = 'LOCAL_OK'
+    LOCAL_INVALID = 'LOCAL_INVALID'
+    REMOTE_OK = 'REMOTE_OK'
+    REMOTE_INVALID = 'REMOTE_INVALID'
+    REMOTE_ERROR = 'REMOTE_ERROR'
+    LOCAL_TRUSTED = 'LOCAL_TRUSTED'
+    KNOWN_OK = 'KNOWN_OK'
+    KNOWN_INVALID = 'KNOWN_INVALID'
+    # placeholder of a result saved out of order later by ReorderBuffer
+    DELAYED = 'DELAYED'
 
-    def __init__(self, **kwargs):
-        _allowed_attrs = self._allowed_attrs()
+    def __str__(self):
+        return self.value
 
-        for key, value in kwargs.items():
-            if key not in _allowed_attrs:
-                raise InvalidAttribute('Keyword argument %s is not allowed',
-                                       key)
-            setattr(self, key, value)
+    def __repr__(self):
+        return repr(self.value)
 
-    def _allowed_attrs(self):
-        return {key for key in self.__class__.__dict__.keys() if not
-                key.startswith('_')}
+
+_STATUSES = {status.value: status for status in Status}
+
+
+class URLStat:
+    """Result of url cleaning.
+
+    Status is stored as Status member, strings are accepted too.
+
+    """
+    __slots__ = ('url', 'local_clean_url', 'remote_clean_url', '_status',
+                 'http_code', 'exception', 'retries', 'seq')
+    _fields = ('url', 'local_clean_url', 'remote_clean_url', 'status',
+               'http_code', 'exception', 'retries', 'seq')
+
+    # diagnostic attributes like retries and input sequence number are not
+    # compared
+    _compared_attrs = ('url', 'local_clean_url', 'remote_clean_url', 'status',
+                       'http_code', 'exception')
+    _compared = attrgetter(*_compared_attrs)
+
+    def __init__(self, *, url=None, local_clean_url=None,
+                 remote_clean_url=None, status=Status.UNCLEANED,
+                 http_code=None, exception=None, retries=0, seq=None,
+                 **kwargs):
+        if kwargs:
+            raise InvalidAttribute('Keyword argument %s is not allowed',
+                                   ', '.join(kwargs))
+
+        self.url = url
+        self.local_clean_url = local_clean_url
+        self.remote_clean_url = remote_clean_url
+        self._status = _STATUSES[status]
+        self.http_code = http_code
+        self.exception = exception
+        self.retries = retries
+        self.seq = seq
+
+    @property
+    def status(self):
+        return self._status
+
+    @status.setter
+    def status(self, status):
+        self._status = _STATUSES[status]
 
     def __repr__(self):
-        params = ['{}={}'.format(key, repr(getattr(self, key))) for key in
-                  self._allowed_attrs()]
+        params = ['{}={!r}'.format(key, getattr(self, key)) for key in
+                  self._fields]
         return 'URLStat({})'.format(', '.join(params))
 
     def __eq__(self, other):
         assert isinstance(other, URLStat)
-        for attr in self._allowed_attrs():
-            mine = getattr(self, attr)
-            their = getattr(other, attr)
-            if mine != their:
-                logger.debug(
-                    '%s attribute is different: %s != %s', attr, mine, their)
-                return False
+        mine = self._compared(self)
+        their = self._compared(other)
+        if mine == their:
+            return True
+
+        for attr, my_value, their_value in zip(self._compared_attrs, mine,
+                                               their):
+            if my_value != their_value:
+                logger.debug('%s attribute is different: %s != %s', attr,
+                             my_value, their_value)
+        return False
+
+
+def local_clean(url, normalizer):
+    """Clean url without remote probing, return URLStat."""
+    local_clean_url = normalizer(url)
+    if local_clean_url:
+        status = Status.LOCAL_OK
+    elif local_clean_url is False:
+        status = Status.LOCAL_INVALID
+        local_clean_url = None
+    else:
+        status = Status.UNCLEANED
+    return URLStat(url=url, local_clean_url=local_clean_url,
+                   remote_clean_url=None, status=status, http_code=None,
+                   exception=None)
+
+
+def local_clean_many(urls, normalizer):
+    """Clean urls without remote probing, return list of URLStats.
+
+    Doesn't need event loop, so it can be used for fast triage of big
+    inputs into LOCAL_OK, LOCAL_INVALID and UNCLEANED urls.
+
+    """
+    return [local_clean(url, normalizer) for url in urls]
+
+
+# Seconds a remote probe result stays fresh in RemoteCache, per status.
+# Statuses missing here are not cached.
+REMOTE_CACHE_TTLS = {
+    'REMOTE_OK': 30 * 24 * 3600,
+    'REMOTE_INVALID': 7 * 24 * 3600,
+    'UNCLEANED': 7 * 24 * 3600,
+    'REMOTE_ERROR': 15 * 60,
+}
+
+
+class RemoteCache:
+    """In-memory LRU cache of remote probe results.
+
+    Entries are keyed on local_clean_url and hold http_code, status and
+    remote_clean_url of the probe. Every entry expires after the TTL
+    configured for its status.
+
+    """
+    def __init__(self, maxsize=100000, ttls=None, *, clock=time.time):
+        self.maxsize = maxsize
+        self.ttls = dict(REMOTE_CACHE_TTLS)
+        self.ttls.update(ttls or {})
+        self.clock = clock
+        self._entries = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        """Return (http_code, status, remote_clean_url) or None."""
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._load(key)
+            if entry is not None:
+                self._remember(key, entry)
+
+        if entry is not None and entry[0] <= self.clock():
+            self.expirations += 1
+            self._forget(key)
+            entry = None
+
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1:]
+
+    def set(self, key, http_code, status, remote_clean_url):
+        ttl = self.ttls.get(status)
+        if not ttl:
+            return
+
+        entry = (self.clock() + ttl, http_code, status, remote_clean_url)
+        self._remember(key, entry)
+        self._store(key, entry)
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'size': len(self._entries),
+        }
+
+    def close(self):
+        pass
+
+    def _remember(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def _forget(self, key):
+        self._entries.pop(key, None)
+
+    def _load(self, key):
+        return None
+
+    def _store(self, key, entry):
+        pass
+
+
+class SQLiteRemoteCache(RemoteCache):
+    """RemoteCache persisted to SQLite database between runs.
+
+    In-memory LRU part works as a read-through front of the database.
+    Processes may share the database file: it is in WAL mode and every
+    write is committed at once, so write locks are held only briefly.
+    Writes failing on a lock busy for longer than timeout are logged and
+    kept in memory only.
+
+    """
+    def __init__(self, path, maxsize=100000, ttls=None, *, timeout=30.0,
+                 clock=time.time):
+        super().__init__(maxsize=maxsize, ttls=ttls, clock=clock)
+        self.path = path
+        self.db = sqlite3.connect(path, timeout=timeout)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS remote_cache ('
+            'key TEXT PRIMARY KEY, expires REAL, http_code INTEGER, '
+            'status TEXT, remote_clean_url TEXT)')
+        self.purge()
+
+    def purge(self):
+        """Delete expired entries from the database."""
+        cursor = self._write('DELETE FROM remote_cache WHERE expires <= ?',
+                             (self.clock(),))
+        if cursor is not None:
+            self.expirations += max(cursor.rowcount, 0)
+
+    def close(self):
+        self.db.close()
+
+    def _write(self, sql, parameters):
+        try:
+            with self.db:
+                return self.db.execute(sql, parameters)
+        except sqlite3.OperationalError as e:
+            logger.warning('Failed to write remote cache %r: %s',
+                           self.path, e)
+            return None
+
+    def _forget(self, key):
+        super()._forget(key)
+        self._write('DELETE FROM remote_cache WHERE key = ?', (key,))
+
+    def _load(self, key):
+        return self.db.execute(
+            'SELECT expires, http_code, status, remote_clean_url '
+            'FROM remote_cache WHERE key = ?', (key,)).fetchone()
+
+    def _store(self, key, entry):
+        self._write(
+            'INSERT OR REPLACE INTO remote_cache VALUES (?, ?, ?, ?, ?)',
+            (key,) + entry)
+
+
+# HTTP codes telling that a host wants us to slow down.
+THROTTLING_CODES = frozenset((429, 503))
+REDIRECT_CODES = frozenset((301, 302, 303, 307, 308))
+SHORTLINK_HOSTS = frozenset(('t.com', 'bit.ly', 'lnkd.in'))
+
+
+def is_shortlink(url, hosts=SHORTLINK_HOSTS):
+    """Return True when url is of a url shortener, one of hosts."""
+    return urlparse(url).netloc.lower() in hosts
+
+
+class ProbePolicy:
+    """Decide which locally cleaned urls need remote verification.
+
+    Urls normalized to a canonical profile url, i.e. starting with one of
+    trusted_prefixes, are trusted without probing. Short urls and other
+    urls, like linkedin /pub/ ones, are always probed. sample_rate of
+    trusted urls are still probed for validation, the sample depends only
+    on the url, so repeated runs probe the same urls.
 
+    """
+    def __init__(self, trusted_prefixes=None, sample_rate=0.0):
+        self.trusted_prefixes = tuple(trusted_prefixes or
+                                      (_TWITTER_URL, _LINKEDIN_URL))
+        self.sample_rate = sample_rate
+        self.trusted = 0
+        self.sampled = 0
+
+    def needs_probe(self, urlstat):
+        url = urlstat.local_clean_url
+        if not url.startswith(self.trusted_prefixes):
+            return True
+
+        if (self.sample_rate and zlib.crc32(url.encode('utf-8')) % 10000 <
+                self.sample_rate * 10000):
+            self.sampled += 1
+            return True
+
+        self.trusted += 1
+        return False
+
+    def stats(self):
+        return {
+            'trusted': self.trusted,
+            'sampled': self.sampled,
+        }
+
+
+class HostLimiter:
+    """Concurrency limit and AIMD-controlled token bucket of one host.
+
+    Request rate is decreased multiplicatively when more than
+    max_throttled share of requests in a healthy_latency window were
+    throttled or timed out, so sporadic errors don't slow the host down.
+    Every healthy response increases the rate by increase / rate, that is
+    by about increase per second at full rate. Burst shrinks with the
+    rate and grows back up to its initial size.
+
+    """
+    def __init__(self, concurrency, rate, *, burst=None, min_rate=0.5,
+                 max_rate=1000.0, increase=0.5, decrease=0.5,
+                 healthy_latency=1.0, max_throttled=0.05, loop=None):
+        self.loop = loop or asyncio.get_event_loop()
+        self.concurrency = concurrency
+        self.semaphore = asyncio.Semaphore(concurrency, loop=self.loop)
+        self.rate = min(rate, max_rate)
+        self.burst = self.max_burst = burst or max(1.0, self.rate)
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.healthy_latency = healthy_latency
+        self.max_throttled = max_throttled
+
+        self.tokens = self.burst
+        self.updated = self.window_start = self.loop.time()
+        self.window_requests = 0
+        self.window_throttled = 0
+        self.in_flight = 0
+        self.requests = 0
+        self.throttled = 0
+
+    @asyncio.coroutine
+    def acquire(self):
+        """Wait for a free slot and a token."""
+        yield from self.semaphore.acquire()
+        try:
+            while True:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    break
+                yield from asyncio.sleep((1 - self.tokens) / self.rate,
+                                         loop=self.loop)
+        except BaseException:
+            self.semaphore.release()
+            raise
+
+        self.in_flight += 1
+        self.requests += 1
+
+    def release(self, latency, throttled=False):
+        """Free the slot and adapt the rate to the request outcome."""
+        self.in_flight -= 1
+        self.semaphore.release()
+
+        self.window_requests += 1
+        if throttled:
+            self.throttled += 1
+            self.window_throttled += 1
+        elif latency < self.healthy_latency:
+            # about rate responses a second, each adds its share
+            self.rate = min(self.max_rate,
+                            self.rate + self.increase / self.rate)
+            self.burst = min(self.max_burst, max(self.burst, self.rate))
+
+        now = self.loop.time()
+        if now - self.window_start < self.healthy_latency:
+            return
+        # one decrease per window, concurrent requests usually fail together
+        if self.window_throttled > self.max_throttled * self.window_requests:
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            self.burst = max(1.0, min(self.burst, self.rate))
+            self.tokens = min(self.tokens, self.burst)
+        self.window_start = now
+        self.window_requests = self.window_throttled = 0
+
+    def _refill(self):
+        now = self.loop.time()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def stats(self):
+        return {
+            'concurrency': self.concurrency,
+            'rate': round(self.rate, 2),
+            'in_flight': self.in_flight,
+            'requests': self.requests,
+            'throttled': self.throttled,
+        }
+
+
+class HostScheduler:
+    """Per-host limiters for remote probing.
+
+    :param host_limits: mapping of host to dict with HostLimiter keyword
+    arguments (concurrency, rate, ...) overriding the defaults.
+
+    """
+    def __init__(self, concurrency=30, rate=100.0, host_limits=None, *,
+                 loop=None, **limiter_kwargs):
+        self.loop = loop or asyncio.get_event_loop()
+        self.concurrency = concurrency
+        self.rate = rate
+        self.host_limits = host_limits or {}
+        self.limiter_kwargs = limiter_kwargs
+        self.limiters = {}
+
+    def limiter(self, host):
+        limiter = self.limiters.get(host)
+        if limiter is None:
+            kwargs = dict(self.limiter_kwargs)
+            kwargs.update(concurrency=self.concurrency, rate=self.rate)
+            kwargs.update(self.host_limits.get(host, {}))
+            limiter = HostLimiter(loop=self.loop, **kwargs)
+            self.limiters[host] = limiter
+        return limiter
+
+    def stats(self):
+        return {host: limiter.stats() for host, limiter in
+                self.limiters.items()}
+
+
+class Backoff:
+    """Exponential backoff with full jitter between retries.
+
+    Delay before retry number n is a random value in
+    [0, min(cap, base * factor ** (n - 1))]. Delay requested by a server in
+    Retry-After header is used instead, but not longer than max_retry_after.
+
+    """
+    def __init__(self, base=0.1, factor=2.0, cap=10.0, jitter=True,
+                 max_retry_after=60.0):
+        self.base = base
+        self.factor = factor
+        self.cap = cap
+        self.jitter = jitter
+        self.max_retry_after = max_retry_after
+
+    def delay(self, retry, retry_after=None):
+        if retry_after is not None:
+            return min(retry_after, self.max_retry_after)
+
+        delay = min(self.cap, self.base * self.factor ** (retry - 1))
+        if self.jitter:
+            delay = random.uniform(0, delay)
+        return delay
+
+
+class RetryBudget:
+    """Limit retries to a share of first attempts in a sliding window.
+
+    Retry is allowed while the number of retries made in the last window
+    seconds is below max(min_retries, ratio * first attempts in the window).
+
+    """
+    def __init__(self, ratio=0.2, window=10.0, min_retries=10, *,
+                 clock=time.monotonic):
+        self.ratio = ratio
+        self.window = window
+        self.min_retries = min_retries
+        self.clock = clock
+        self._attempts = deque()
+        self._retries = deque()
+
+        self.attempts = 0
+        self.retries = 0
+        self.rejected = 0
+
+    def attempt(self):
+        """Register first attempt of a request."""
+        self.attempts += 1
+        self._attempts.append(self.clock())
+
+    def can_retry(self):
+        """Register and allow retry if budget is not exhausted."""
+        now = self.clock()
+        for timestamps in (self._attempts, self._retries):
+            while timestamps and timestamps[0] <= now - self.window:
+                timestamps.popleft()
+
+        allowed = max(self.min_retries, self.ratio * len(self._attempts))
+        if len(self._retries) >= allowed:
+            self.rejected += 1
+            return False
+
+        self.retries += 1
+        self._retries.append(now)
         return True
 
+    def stats(self):
+        return {
+            'attempts': self.attempts,
+            'retries': self.retries,
+            'rejected': self.rejected,
+        }
+
+
+def parse_retry_after(value):
+    """Return Retry-After header value in seconds or None."""
+    if not value:
+        return None
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        logger.debug('Invalid Retry-After %r', value)
+        return None
+    return max(0.0, date.timestamp() - time.time())
+
+
+class Journal:
+    """Append-only journal of completed input sequence numbers.
+
+    Every completed url is stored as 8 bytes record. In memory completed
+    numbers are kept as a watermark, below which all inputs are completed,
+    and a set of completed numbers above it.
+
+    Records are buffered until flush(), which should be called after the
+    results of recorded urls are persisted.
+
+    """
+    _record = struct.Struct('<Q')
+
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.watermark = 0
+        self.completed = set()
+        self._pending = bytearray()
+
+        if resume and os.path.exists(path):
+            self._load()
+            self.ioobj = open(path, 'ab')
+        else:
+            self.ioobj = open(path, 'wb')
+
+    def _load(self):
+        with open(self.path, 'r+b') as ioobj:
+            data = ioobj.read()
+            size = len(data) - len(data) % self._record.size
+            if size != len(data):
+                logger.warning('Truncating partially written record of %s',
+                               self.path)
+                ioobj.truncate(size)
+
+        for seq, in self._record.iter_unpack(data[:size]):
+            self._add(seq)
+
+    def _add(self, seq):
+        if seq == self.watermark:
+            self.watermark += 1
+            while self.watermark in self.completed:
+                self.completed.remove(self.watermark)
+                self.watermark += 1
+        elif seq > self.watermark:
+            self.completed.add(seq)
+
+    def __len__(self):
+        return self.watermark + len(self.completed)
+
+    def is_completed(self, seq):
+        return seq < self.watermark or seq in self.completed
+
+    def record(self, seq):
+        self._add(seq)
+        self._pending += self._record.pack(seq)
+
+    def take(self):
+        """Return and forget records not written yet."""
+        pending = bytes(self._pending)
+        self._pending.clear()
+        return pending
+
+    def write(self, records):
+        self.ioobj.write(records)
+        self.ioobj.flush()
+
+    def flush(self):
+        self.write(self.take())
+
+    def close(self):
+        self.flush()
+        self.ioobj.close()
+
+
+class ReorderBuffer:
+    """Save URLStats through result_saver in order of their seq.
+
+    URLStats completed out of order are held until all preceding ones are
+    saved, at most about capacity of them. When more are needed:
+
+    block - URLCleaner doesn't take inputs capacity or more ahead of the
+    oldest unsaved one until it is saved.
+    placeholder - the oldest missing URLStat is saved as DELAYED
+    placeholder and saved later as soon as it is completed, so the later
+    row of an url wins.
+
+    """
+    policies = ('block', 'placeholder')
+
+    def __init__(self, result_saver, capacity=10000, policy='block', *,
+                 loop=None):
+        if policy not in self.policies:
+            raise ValueError('Unknown policy {}'.format(policy))
+        self.result_saver = result_saver
+        self.capacity = capacity
+        self.policy = policy
+        self.loop = loop or asyncio.get_event_loop()
+        self.next_seq = 0
+        self.held = {}
+        self.urls = {}
+        self.delayed = set()
+        self._room = None
+
+        self.max_held = 0
+        self.blocked = 0
+        self.placeholders = 0
+        self.patched = 0
+
+    @asyncio.coroutine
+    def expect(self, seq, url):
+        """Register input, wait for room in the buffer with block policy."""
+        if self.policy == 'placeholder':
+            self.urls[seq] = url.url if isinstance(url, URLStat) else url
+            return
+
+        while seq >= self.next_seq + self.capacity:
+            if self._room is None:
+                self._room = asyncio.Future(loop=self.loop)
+            self.blocked += 1
+            yield from self._room
+
+    def write(self, urlstat):
+        """Save or hold urlstat, return what result_saver returned last."""
+        if urlstat.seq in self.delayed:
+            self.delayed.remove(urlstat.seq)
+            self.patched += 1
+            return self.result_saver(urlstat)
+
+        self.held[urlstat.seq] = urlstat
+        return self._drain()
+
+    __call__ = write
+
+    def _drain(self):
+        saving = None
+        first_seq = self.next_seq
+        try:
+            while True:
+                seq = self.next_seq
+                urlstat = self.held.pop(seq, None)
+                if urlstat is None:
+                    if (self.policy != 'placeholder' or
+                            len(self.held) <= self.capacity):
+                        break
+                    urlstat = URLStat(url=self.urls.get(seq),
+                                      status=Status.DELAYED, seq=seq)
+                    self.delayed.add(seq)
+                    self.placeholders += 1
+                self.urls.pop(seq, None)
+                # a row result_saver raises on is skipped, not saved again
+                self.next_seq += 1
+                # results are saved in order, so the last one is waited for
+                saving = self.result_saver(urlstat) or saving
+        finally:
+            self.max_held = max(self.max_held, len(self.held))
+            if self.next_seq != first_seq and self._room is not None:
+                self._room.set_result(None)
+                self._room = None
+        return saving
+
+    def close(self):
+        """Save held URLStats, skipping missing ones."""
+        for seq in sorted(self.held):
+            self.result_saver(self.held.pop(seq))
+
+    def stats(self):
+        return {
+            'held': len(self.held),
+            'max_held': self.max_held,
+            'blocked': self.blocked,
+            'placeholders': self.placeholders,
+            'patched': self.patched,
+        }
+
+
+class LatencyHistogram:
+    """Histogram of latencies with logarithmic buckets.
+
+    Bucket bounds grow by factor from min_latency up to max_latency,
+    percentiles are reported as upper bounds of buckets.
+
+    """
+    def __init__(self, min_latency=0.001, max_latency=60.0, factor=1.25):
+        self.bounds = []
+        bound = min_latency
+        while bound < max_latency:
+            self.bounds.append(bound)
+            bound *= factor
+        self.bounds.append(max_latency)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, latency):
+        self.counts[bisect.bisect_left(self.bounds, latency)] += 1
+        self.count += 1
+        self.total += latency
+        self.max = max(self.max, latency)
+
+    def percentile(self, percent):
+        if not self.count:
+            return None
+
+        rank = self.count * percent / 100
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return round(min(bound, self.max), 4)
+        return round(self.max, 4)
+
+    def stats(self):
+        return {
+            'count': self.count,
+            'mean': round(self.total / self.count, 4) if self.count else None,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'max': round(self.max, 4),
+        }
+
+
+class Metrics:
+    """Live counters of URLCleaner run."""
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.t0 = clock()
+        self.urls_in = 0
+        self.urls_out = 0
+        self.retries = 0
+        self.statuses = Counter()
+        self.latencies = {}
+        self._last = (self.t0, 0, 0)
+
+    def url_in(self):
+        self.urls_in += 1
+
+    def url_out(self, urlstat):
+        self.urls_out += 1
+        self.retries += urlstat.retries
+        self.statuses[str(urlstat.status)] += 1
+
+    def observe_latency(self, host, latency):
+        histogram = self.latencies.get(host)
+        if histogram is None:
+            histogram = self.latencies[host] = LatencyHistogram()
+        histogram.observe(latency)
+
+    def snapshot(self):
+        """Return counters with rates overall and since last snapshot."""
+        now = self.clock()
+        last_time, last_in, last_out = self._last
+        self._last = (now, self.urls_in, self.urls_out)
+        elapsed = max(now - self.t0, 1e-9)
+        interval = max(now - last_time, 1e-9)
+        return {
+            'elapsed': round(elapsed, 3),
+            'urls_in': self.urls_in,
+            'urls_out': self.urls_out,
+            'in_per_second': round(self.urls_in / elapsed, 1),
+            'out_per_second': round(self.urls_out / elapsed, 1),
+            'recent_in_per_second': round(
+                (self.urls_in - last_in) / interval, 1),
+            'recent_out_per_second': round(
+                (self.urls_out - last_out) / interval, 1),
+            'retries': self.retries,
+            'statuses': dict(self.statuses),
+            'latency': {host: histogram.stats() for host, histogram in
+                        self.latencies.items()},
+        }
+
+
+class Autoscaler:
+    """Hill-climbing controller of the number of URLCleaner workers.
+
+    The pool grows by step while the queue has a backlog and throughput
+    doesn't drop. It shrinks multiplicatively when error rate or mean
+    latency exceed their limits or throughput dropped after growth, and
+    by one worker when the queue is empty.
+
+    """
+    def __init__(self, min_workers, max_workers, *, interval=1.0, step=0.25,
+                 backlog=0.5, max_error_rate=0.05, max_latency=None):
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.interval = interval
+        self.step = step
+        self.backlog = backlog
+        self.max_error_rate = max_error_rate
+        self.max_latency = max_latency
+
+        self.last_throughput = None
+        self.grew = False
+
+    def decide(self, workers, throughput, backlog, error_rate, latency):
+        """Return new number of workers."""
+        if (error_rate > self.max_error_rate or
+                (self.max_latency and latency and
+                 latency > self.max_latency)):
+            target = int(workers * (1 - self.step))
+        elif (self.grew and self.last_throughput and
+              throughput < self.last_throughput * 0.95):
+            target = int(workers * (1 - self.step / 2))
+        elif backlog >= self.backlog:
+            target = max(workers + 1, int(workers * (1 + self.step)))
+        elif backlog == 0:
+            target = workers - 1
+        else:
+            target = workers
+
+        target = max(self.min_workers, min(self.max_workers, target))
+        self.grew = target > workers
+        self.last_throughput = throughput
+        return target
+
+
+class Profiler:
+    """Time spent in stages of cleaning.
+
+    URLCleaner records stages when it has a profiler, every stage is
+    passed to hooks added by add_hook() too, as hook(stage, started,
+    elapsed), e.g. to export tracing spans. Stages of concurrent probes
+    overlap, so their totals may exceed the run time.
+
+    read - reading input, recorded by iterate()
+    local_clean - local cleaning, including normalization
+    queue_wait - workers waiting for urls to clean
+    remote_clean - remote cleaning of an url with all its tries
+    host_wait - waiting for a host limiter before a try
+    request - HEAD request of a try, including connecting
+    dns, connect - resolving hosts and opening TCP and TLS connections,
+    connect includes dns
+    backoff - waiting between tries
+    save - saving results
+
+    """
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+        self.hooks = []
+        self.totals = Counter()
+        self.counts = Counter()
+        self.t0 = clock()
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def record(self, stage, started, elapsed=None):
+        """Record stage started at clock value started."""
+        if elapsed is None:
+            elapsed = self.clock() - started
+        self.totals[stage] += elapsed
+        self.counts[stage] += 1
+        for hook in self.hooks:
+            hook(stage, started, elapsed)
+
+    def iterate(self, stage, iterable):
+        """Yield items of iterable recording time spent to get them."""
+        iterator = iter(iterable)
+        clock = self.clock
+        while True:
+            started = clock()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.record(stage, started)
+            yield item
+
+    def wrap(self, stage, func):
+        """Return func recording its calls as stage."""
+        def profiled(*args, **kwargs):
+            with self.stage(stage):
+                return func(*args, **kwargs)
+        return profiled
+
+    @contextmanager
+    def stage(self, stage):
+        """Record the with block as stage."""
+        started = self.clock()
+        try:
+            yield
+        finally:
+            self.record(stage, started)
+
+    def stats(self):
+        return {
+            'elapsed': round(self.clock() - self.t0, 3),
+            'stages': {stage: {
+                'count': self.counts[stage],
+                'total': round(total, 3),
+                'mean_ms': round(total / self.counts[stage] * 1000, 3),
+            } for stage, total in self.totals.items()},
+        }
+
+
+class NullProfiler:
+    """Profiler recording nothing, used when profiling is off."""
+
+    def clock(self):
+        return 0.0
+
+    def record(self, stage, started, elapsed=None):
+        pass
+
+    def iterate(self, stage, iterable):
+        return iterable
+
+    def wrap(self, stage, func):
+        return func
+
+    def stage(self, stage):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def stats(self):
+        return None
+
+
+class ConnectionStats:
+    """Connector mixin counting opened and reused connections.
+
+    Connecting is recorded by profiler, when it is set.
+
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.connects = 0
+        self.opened = 0
+        self.profiler = NullProfiler()
+
+    @asyncio.coroutine
+    def connect(self, req):
+        self.connects += 1
+        return (yield from super().connect(req))
+
+    @asyncio.coroutine
+    def _create_connection(self, req):
+        self.opened += 1
+        with self.profiler.stage('connect'):
+            return (yield from super()._create_connection(req))
+
+    @asyncio.coroutine
+    def _resolve_host(self, host, port):
+        with self.profiler.stage('dns'):
+            return (yield from super()._resolve_host(host, port))
+
+    def connection_stats(self):
+        return {
+            'opened': self.opened,
+            'reused': self.connects - self.opened,
+            'idle': sum(len(conns) for conns in self._conns.values()),
+        }
+
+
+class TCPConnector(ConnectionStats, aiohttp.TCPConnector):
+    pass
+
+
+class ProxyConnector(ConnectionStats, aiohttp.ProxyConnector):
+    pass
+
 
 class URLCleaner:
     """Preprocess and clean urls."""
     def __init__(self, urls, normalizer, result_saver=print,
                  qsize=None, result_qsize=None, num_workers=1,
-                 max_tries=4, timeout=3, max_connections=30, *, loop=None):
+                 max_tries=4, timeout=3, max_connections=30, cache=None,
+                 dedup_size=100000, scheduler=None, backoff=None,
+                 retry_budget=None, journal=None, autoscaler=None,
+                 expand_shortlinks=True, verify_shortlinks=True,
+                 max_redirects=5, policy=None, known_ok=None,
+                 known_invalid=None, keepalive_timeout=30, work_queue=None,
+                 reorder_buffer=None, normalizer_cache_size=100000,
+                 profiler=None, shortlink_hosts=SHORTLINK_HOSTS, *,
+                 loop=None):
         """Async URLCleaner.
 
         :param normalizer: callable that takes url and returns normalized url
         or False when url is invalid or None, when url can't be validated.
+        :param cache: optional RemoteCache consulted before remote cleaning.
+        :param dedup_size: how many finished remote probes are remembered to
+        be shared with subsequent urls having the same local_clean_url.
+        :param scheduler: HostScheduler limiting probes per host, by default
+        every host may use all max_connections.
+        :param backoff: Backoff computing delays between tries.
+        :param retry_budget: RetryBudget shared by all remote probes.
+        :param journal: Journal where sequence numbers of saved urls are
+        recorded, urls completed in it are skipped.
+        :param autoscaler: Autoscaler changing the number of workers during
+        the run, num_workers is the initial number then.
+        :param expand_shortlinks: follow redirects of short urls manually
+        up to max_redirects, only until they point to a profile. Targets
+        of short urls are remembered like finished probes.
+        :param verify_shortlinks: probe profiles short urls redirect to,
+        otherwise they are trusted.
+        :param policy: ProbePolicy deciding which LOCAL_OK urls are probed,
+        others get LOCAL_TRUSTED status. By default all are probed.
+        :param known_ok: urlindex.URLIndex of local clean urls verified
+        before, mapped to their http code and remote clean url. They get
+        KNOWN_OK status without probing.
+        :param known_invalid: urlindex.URLIndex of local clean urls found
+        invalid before, they get KNOWN_INVALID status without probing.
+        :param keepalive_timeout: seconds idle connections are kept open for
+        next probes of the same host.
+        :param work_queue: workqueue.WorkQueue urls were leased from, seq of
+        saved URLStats is acknowledged in it with the result. REMOTE_ERROR
+        results are not saved but failed in it, to be retried.
+        :param reorder_buffer: ReorderBuffer results are saved through,
+        inputs wait for room in it.
+        :param normalizer_cache_size: how many normalizer results are
+        memoized, unless normalizer is a MemoizedNormalizer already.
+        :param profiler: Profiler recording time spent in cleaning stages.
+        :param shortlink_hosts: hosts of url shorteners expanded with
+        expand_shortlinks.
 
         """
         self.urls = urls
+        if (normalizer_cache_size and
+                not isinstance(normalizer, MemoizedNormalizer)):
+            normalizer = MemoizedNormalizer(normalizer,
+                                            maxsize=normalizer_cache_size)
         self.normalizer = normalizer
         self.result_saver = result_saver
+        self.cache = cache
+        self.journal = journal
+        self.dedup_size = dedup_size
+        self._probes = OrderedDict()
+        self.deduplicated = 0
+        self.expand_shortlinks = expand_shortlinks
+        self.verify_shortlinks = verify_shortlinks
+        self.max_redirects = max_redirects
+        self.shortlink_hosts = shortlink_hosts
+        self._expansions = OrderedDict()
+        self.reused_expansions = 0
+        self.policy = policy
+        self.known_ok = known_ok
+        self.known_invalid = known_invalid
+        self.work_queue = work_queue
+        self.reorder_buffer = reorder_buffer
+        self.profiler = profiler or NullProfiler()
+
+        self.autoscaler = autoscaler
+        self.concurrency_history = []
+        self._retiring = 0
+        self.workers = []
+        self.scaler = None
+        self.consumer = None
+        max_workers = max(num_workers,
+                          autoscaler.max_workers if autoscaler else 0)
 
         self.loop = loop or asyncio.get_event_loop()
-        self.q = Queue(maxsize=qsize or num_workers * 10, loop=self.loop)
-        self.result_q = Queue(maxsize=result_qsize or num_workers * 10,
+        self.q = Queue(maxsize=qsize or max_workers * 10, loop=self.loop)
+        self.result_q = Queue(maxsize=result_qsize or max_workers * 10,
                               loop=self.loop)
 
         self.num_workers = num_workers
         self.max_tries = max_tries
         self.timeout = timeout
+        self.max_connections = max_connections
+        # one session and keep-alive connection pool for all probes,
+        # connections also share resolved hosts and the SSL context
+        connector_kwargs = {
+            'limit': max_connections,
+            'keepalive_timeout': keepalive_timeout,
+            'force_close': False,
+            'resolve': True,
+            'loop': self.loop,
+        }
         proxy = os.environ.get('http_proxy')
         if proxy:
-            self.connector = aiohttp.ProxyConnector(proxy=proxy,
-                                                    limit=max_connections,
-                                                    loop=self.loop)
+            self.connector = ProxyConnector(proxy=proxy, **connector_kwargs)
         else:
-            self.connector = aiohttp.TCPConnector(limit=max_connections,
-                                                  loop=self.loop)
+            self.connector = TCPConnector(**connector_kwargs)
+        self.connector.profiler = self.profiler
+        self.session = aiohttp.ClientSession(connector=self.connector,
+                                             loop=self.loop)
+        self.scheduler = scheduler or HostScheduler(
+            concurrency=max_connections, loop=self.loop)
+        self.backoff = backoff or Backoff()
+        self.retry_budget = retry_budget or RetryBudget()
+        self.metrics = Metrics()
 
         self.t0 = time.time()
         self.t1 = None
         self.clean_task = None
 
     def local_clean(self, url):
-        local_clean_url = self.normalizer(url)
-        if local_clean_url:
-            status = 'LOCAL_OK'
-        elif local_clean_url is False:
-            status = 'LOCAL_INVALID'
-            local_clean_url = None
-        else:
-            status = 'UNCLEANED'
-        return URLStat(url=url, local_clean_url=local_clean_url,
-                       remote_clean_url=None, status=status, http_code=None,
-                       exception=None)
+        with self.profiler.stage('local_clean'):
+            return local_clean(url, self.normalizer)
+
+    def local_clean_many(self, urls):
+        return local_clean_many(urls, self.normalizer)
 
     @asyncio.coroutine
     def remote_clean(self, urlstat):
         """Check URL by HEAD probing it."""
+        url = urlstat.local_clean_url
+        if (self.expand_shortlinks and
+                is_shortlink(url, self.shortlink_hosts)):
+            return (yield from self.expand(urlstat))
+
+        response = yield from self._head(urlstat, url)
+        if response is None:
+            return urlstat
+        return self._apply_response(urlstat, response)
+
+    @asyncio.coroutine
+    def _request(self, url, allow_redirects):
+        response = yield from asyncio.wait_for(
+            self.session.request('head', url,
+                                 allow_redirects=allow_redirects,
+                                 headers={'Accept-Encoding': 'identity'}),
+            self.timeout, loop=self.loop)
+        # return the connection to the pool, close() drops it
+        yield from response.release()
+        return response
+
+    def _throttled(self, response, tries, url):
+        """Return seconds to wait requested by throttling response."""
+        logger.info('Try %r for %r throttled with %r', tries, url,
+                    response.status)
+        return parse_retry_after(response.headers.get('RETRY-AFTER'))
+
+    def _can_retry(self, tries, url):
+        if tries >= self.max_tries:
+            return False
+        if not self.retry_budget.can_retry():
+            logger.info('Retry budget is exhausted, giving up %r', url)
+            return False
+        return True
+
+    @asyncio.coroutine
+    def _head(self, urlstat, url, allow_redirects=True):
+        """Return HEAD response for url, retrying failed requests.
+
+        None is returned when all tries failed, urlstat is updated with
+        the error then.
+
+        """
         tries = 0
         exception = None
-        url = urlstat.local_clean_url
-        headers = {
-            'Accept-Encoding': 'identity',
-        }
+        retry_after = None
+        host = urlparse(url).netloc.lower()
+        limiter = self.scheduler.limiter(host)
+        self.retry_budget.attempt()
         while tries < self.max_tries:
+            with self.profiler.stage('host_wait'):
+                yield from limiter.acquire()
+            started = self.loop.time()
+            response = None
+            throttled = False
             try:
-                response = yield from asyncio.wait_for(
-                    aiohttp.request('head', url, allow_redirects=True,
-                                    headers=headers,
-                                    connector=self.connector, loop=self.loop),
-                    self.timeout, loop=self.loop)
-                response.close()
-
-                if tries > 1:
-                    logger.info('Try %r for %r success', tries, url)
-                break
+                response = yield from self._request(url, allow_redirects)
+                throttled = response.status in THROTTLING_CODES
+
+                if not throttled:
+                    if tries > 1:
+                        logger.info('Try %r for %r success', tries, url)
+                    break
+
+                retry_after = self._throttled(response, tries, url)
+                exception = None
 
             except ValueError as error:
                 # do not need to retry for these errors
@@ -147,89 +1250,426 @@ class URLCleaner:
 
             except aiohttp.HttpProcessingError as e:
                 logger.error('Got http error for %r, exception %s', url, e)
+                throttled = e.code in THROTTLING_CODES
                 urlstat.http_code = e.code
-                urlstat.status = 'REMOTE_ERROR'
+                urlstat.status = Status.REMOTE_ERROR
                 urlstat.exception = e
-                return urlstat
+                return None
 
             except (aiohttp.ClientError, asyncio.TimeoutError) as error:
                 logger.info('Try %r for %r raised %s, %s', tries, url,
                             type(error), error)
+                throttled = isinstance(error, asyncio.TimeoutError)
                 exception = error
 
+            finally:
+                latency = self.loop.time() - started
+                limiter.release(latency, throttled)
+                self.metrics.observe_latency(host, latency)
+                self.profiler.record(
+                    'request', self.profiler.clock() - latency, latency)
+
             tries += 1
-            yield from asyncio.sleep(0.1)
+            if not self._can_retry(tries, url):
+                tries = self.max_tries
+                continue
+
+            urlstat.retries += 1
+            with self.profiler.stage('backoff'):
+                yield from asyncio.sleep(
+                    self.backoff.delay(tries, retry_after), loop=self.loop)
+            retry_after = None
         else:
             # all tries failed
             logger.error('all tries for %r failed, exception %s', url,
                          exception)
-            urlstat.status = 'REMOTE_ERROR'
+            urlstat.status = Status.REMOTE_ERROR
             urlstat.exception = exception
+            if response is not None:
+                urlstat.http_code = response.status
+            return None
+
+        return response
+
+    @asyncio.coroutine
+    def expand(self, urlstat):
+        """Clean short url by following its redirects manually.
+
+        Redirects are followed only until the location normalizes to a
+        profile url, the profile is probed as any other url then, sharing
+        probes and cache with them. Without verify_shortlinks the profile
+        is trusted without probing.
+
+        """
+        url = urlstat.local_clean_url
+        expansion = self._expansions.get(url)
+        if expansion is not None:
+            self._expansions.move_to_end(url)
+            self.reused_expansions += 1
+        else:
+            location = url
+            for _ in range(self.max_redirects):
+                response = yield from self._head(urlstat, location,
+                                                 allow_redirects=False)
+                if response is None:
+                    return urlstat
+                if response.status not in REDIRECT_CODES:
+                    return self._apply_response(urlstat, response)
+
+                location = urljoin(location,
+                                   response.headers.get('LOCATION', ''))
+                normalized = self.normalizer(location)
+                if normalized and not is_shortlink(normalized,
+                                                   self.shortlink_hosts):
+                    expansion = (response.status, normalized)
+                    break
+            else:
+                logger.info('Too many redirects for %r', url)
+                urlstat.status = Status.REMOTE_ERROR
+                urlstat.http_code = response.status
+                return urlstat
+
+            self._expansions[url] = expansion
+            while len(self._expansions) > self.dedup_size:
+                self._expansions.popitem(last=False)
+
+        http_code, target = expansion
+        if not self.verify_shortlinks:
+            urlstat.http_code = http_code
+            urlstat.status = Status.REMOTE_OK
+            urlstat.remote_clean_url = target
             return urlstat
 
+        probe = URLStat(url=url, local_clean_url=target,
+                        status=Status.LOCAL_OK)
+        if not self._from_cache(probe):
+            yield from self._shared_remote_clean(probe)
+        urlstat.http_code = probe.http_code
+        urlstat.status = probe.status
+        urlstat.remote_clean_url = probe.remote_clean_url
+        urlstat.exception = probe.exception
+        urlstat.retries += probe.retries
+        return urlstat
+
+    def _apply_response(self, urlstat, response):
         urlstat.http_code = response.status
 
         if response.status == 200:
             remote_clean_url = self.normalizer(response.url)
             if remote_clean_url:
-                urlstat.status = 'REMOTE_OK'
+                urlstat.status = Status.REMOTE_OK
                 urlstat.remote_clean_url = remote_clean_url
             elif remote_clean_url is False:
-                urlstat.status = 'REMOTE_INVALID'
+                urlstat.status = Status.REMOTE_INVALID
             else:
                 # url requires authorization, can't clean
-                urlstat.status = 'UNCLEANED'
+                urlstat.status = Status.UNCLEANED
         else:
-            urlstat.status = 'REMOTE_INVALID'
+            urlstat.status = Status.REMOTE_INVALID
 
         return urlstat
 
     @asyncio.coroutine
     def process_url(self, url):
-        urlstat = self.local_clean(url)
-        if urlstat.status == 'LOCAL_OK':
-            urlstat = yield from self.remote_clean(urlstat)
+        """Clean url, which may be already locally cleaned URLStat."""
+        if isinstance(url, URLStat):
+            urlstat = url
+        else:
+            urlstat = self.local_clean(url)
+        if urlstat.status is not Status.LOCAL_OK or self._from_index(urlstat):
+            return urlstat
+
+        if self.policy is not None and not self.policy.needs_probe(urlstat):
+            urlstat.status = Status.LOCAL_TRUSTED
+        elif not self._from_cache(urlstat):
+            with self.profiler.stage('remote_clean'):
+                yield from self._shared_remote_clean(urlstat)
         return urlstat
 
+    @asyncio.coroutine
+    def _shared_remote_clean(self, urlstat):
+        """Remote clean urlstat sharing one probe per local_clean_url."""
+        key = urlstat.local_clean_url
+        probe = self._probes.get(key)
+        if probe is not None:
+            self.deduplicated += 1
+            # a cancelled waiter must not cancel the probe of others
+            result = yield from asyncio.shield(probe, loop=self.loop)
+            if result is not None:
+                (urlstat.http_code, urlstat.status, urlstat.remote_clean_url,
+                 urlstat.exception) = result
+                return urlstat
+            # probe owner was cancelled, probe by ourselves
+
+        probe = asyncio.Future(loop=self.loop)
+        self._probes[key] = probe
+        try:
+            yield from self.remote_clean(urlstat)
+            self._to_cache(urlstat)
+        except BaseException:
+            self._forget_probe(key, probe)
+            probe.set_result(None)
+            raise
+
+        probe.set_result((urlstat.http_code, urlstat.status,
+                          urlstat.remote_clean_url, urlstat.exception))
+        if urlstat.status is Status.REMOTE_ERROR:
+            # errors may be transient, they are shared only with urls
+            # waiting for this probe, RemoteCache keeps them briefly
+            self._forget_probe(key, probe)
+
+        while len(self._probes) > self.dedup_size:
+            oldest = next(iter(self._probes))
+            if not self._probes[oldest].done():
+                break
+            del self._probes[oldest]
+
+        return urlstat
+
+    def _forget_probe(self, key, probe):
+        # a newer probe of the key may have replaced this one
+        if self._probes.get(key) is probe:
+            del self._probes[key]
+
+    def _from_index(self, urlstat):
+        url = urlstat.local_clean_url
+        if self.known_ok is not None:
+            known = self.known_ok.get(url)
+            if known is not None:
+                urlstat.http_code, urlstat.remote_clean_url = known
+                urlstat.status = Status.KNOWN_OK
+                return True
+
+        if (self.known_invalid is not None and
+                self.known_invalid.get(url) is not None):
+            urlstat.status = Status.KNOWN_INVALID
+            return True
+        return False
+
+    def _from_cache(self, urlstat):
+        if self.cache is None:
+            return False
+
+        cached = self.cache.get(urlstat.local_clean_url)
+        if cached is None:
+            return False
+        if (self.work_queue is not None and
+                cached[1] == Status.REMOTE_ERROR):
+            # the queue retries remote errors, they are probed again
+            return False
+
+        urlstat.http_code, status, urlstat.remote_clean_url = cached
+        urlstat.status = _STATUSES[status]
+        return True
+
+    def _to_cache(self, urlstat):
+        if self.cache is None or (self.work_queue is not None and
+                                  urlstat.status is Status.REMOTE_ERROR):
+            return
+        self.cache.set(urlstat.local_clean_url, urlstat.http_code,
+                       urlstat.status, urlstat.remote_clean_url)
+
     def close(self):
         """Close resources."""
-        self.connector.close()
+        self.session.close()
+
+    def stats(self):
+        """Return live run statistics as JSON serializable dict."""
+        stats = self.metrics.snapshot()
+        active = sum(limiter.in_flight for limiter in
+                     self.scheduler.limiters.values())
+        stats.update({
+            'workers': self.num_workers,
+            'concurrency_history': self.concurrency_history,
+            'queue': self.q.qsize(),
+            'result_queue': self.result_q.qsize(),
+            'connections': {
+                'active': active,
+                'limit': self.max_connections,
+                'utilization': round(active / self.max_connections, 3),
+            },
+            'pool': self.connector.connection_stats(),
+            'deduplicated': self.deduplicated,
+            'reused_expansions': self.reused_expansions,
+            'hosts': self.scheduler.stats(),
+            'retry_budget': self.retry_budget.stats(),
+        })
+        if self.cache is not None:
+            stats['cache'] = self.cache.stats()
+        if self.policy is not None:
+            stats['policy'] = self.policy.stats()
+        if self.known_ok is not None:
+            stats['known_ok'] = self.known_ok.stats()
+        if self.known_invalid is not None:
+            stats['known_invalid'] = self.known_invalid.stats()
+        if self.work_queue is not None:
+            stats['work_queue'] = self.work_queue.stats()
+        if self.reorder_buffer is not None:
+            stats['reorder_buffer'] = self.reorder_buffer.stats()
+        if isinstance(self.normalizer, MemoizedNormalizer):
+            stats['normalizer'] = self.normalizer.stats()
+        profile = self.profiler.stats()
+        if profile is not None:
+            stats['profile'] = profile
+        return stats
 
     @asyncio.coroutine
     def save_results(self):
-        """Save cleaned URLStat."""
+        """Save cleaned URLStat.
+
+        result_saver may return a coroutine or a future, e.g. when it writes
+        results in an executor, it is waited before saving the next result.
+
+        """
         while True:
             urlstat = yield from self.result_q.get()
-            try:
-                self.result_saver(urlstat)
-            except StopIteration:
-                self.cancel()
+            if (self.work_queue is not None and
+                    urlstat.status is Status.REMOTE_ERROR):
+                # retried by this or other nodes until dead-lettered
+                self.work_queue.fail(urlstat.seq,
+                                     str(urlstat.exception or urlstat.status))
+            else:
+                yield from self._save(urlstat)
+            self.result_q.task_done()
 
-            except Exception as e: # noqa
-                logger.exception(e)
+    @asyncio.coroutine
+    def _save(self, urlstat):
+        try:
+            with self.profiler.stage('save'):
+                saving = self.result_saver(urlstat)
+                if (asyncio.iscoroutine(saving) or
+                        isinstance(saving, asyncio.Future)):
+                    yield from saving
+        except StopIteration:
+            self.cancel()
 
-            self.result_q.task_done()
+        except Exception as e: # noqa
+            logger.exception(e)
+            if self.work_queue is not None:
+                self.work_queue.fail(urlstat.seq, str(e))
+
+        else:
+            self.metrics.url_out(urlstat)
+            if self.journal is not None:
+                self.journal.record(urlstat.seq)
+            if self.work_queue is not None:
+                self.work_queue.ack(urlstat.seq, urlstat)
 
     @asyncio.coroutine
     def work(self):
-        """Process queue items forever."""
-        while True:
-            url = yield from self.q.get()
+        """Process queue items until the worker is retired."""
+        while not self._retire():
+            with self.profiler.stage('queue_wait'):
+                seq, url = yield from self.q.get()
             urlstat = yield from self.process_url(url)
+            urlstat.seq = seq
             self.q.task_done()
             yield from self.result_q.put(urlstat)
 
+    def _retire(self):
+        if self._retiring:
+            self._retiring -= 1
+            return True
+        return False
+
+    def resize(self, num_workers):
+        """Start or retire workers to have num_workers of them."""
+        if num_workers > self.num_workers:
+            self.workers = [w for w in self.workers if not w.done()]
+            for _ in range(num_workers - self.num_workers):
+                self.workers.append(asyncio.Task(self.work(), loop=self.loop))
+        else:
+            # workers retire when they are done with their current url
+            self._retiring += self.num_workers - num_workers
+
+        self.num_workers = num_workers
+        self.concurrency_history.append(
+            (round(time.time() - self.t0, 3), num_workers))
+
+    @asyncio.coroutine
+    def autoscale(self):
+        """Resize workers pool by autoscaler decisions forever."""
+        last_out = self.metrics.urls_out
+        last_requests, last_throttled, last_count, last_total = (
+            self._probe_totals())
+        while True:
+            yield from asyncio.sleep(self.autoscaler.interval, loop=self.loop)
+
+            requests, throttled, count, total = self._probe_totals()
+            throughput = ((self.metrics.urls_out - last_out) /
+                          self.autoscaler.interval)
+            error_rate = ((throttled - last_throttled) /
+                          max(requests - last_requests, 1))
+            latency = ((total - last_total) / (count - last_count) if
+                       count > last_count else None)
+            backlog = self.q.qsize() / self.q.maxsize
+
+            num_workers = self.autoscaler.decide(
+                self.num_workers, throughput, backlog, error_rate, latency)
+            if num_workers != self.num_workers:
+                logger.debug('Resizing workers %d -> %d', self.num_workers,
+                             num_workers)
+                self.resize(num_workers)
+
+            last_out = self.metrics.urls_out
+            last_requests, last_throttled = requests, throttled
+            last_count, last_total = count, total
+
+    def _probe_totals(self):
+        limiters = self.scheduler.limiters.values()
+        histograms = self.metrics.latencies.values()
+        return (sum(limiter.requests for limiter in limiters),
+                sum(limiter.throttled for limiter in limiters),
+                sum(histogram.count for histogram in histograms),
+                sum(histogram.total for histogram in histograms))
+
+    def _start(self):
+        """Start workers and autoscaler."""
+        self.t0 = time.time()
+        self.num_workers, num_workers = 0, self.num_workers
+        self.resize(num_workers)
+        if self.autoscaler is not None:
+            self.scaler = asyncio.Task(self.autoscale(), loop=self.loop)
+
+    @asyncio.coroutine
+    def _feed(self, urls):
+        """Put urls into the queue, waiting while it is full.
+
+        urls may be an iterable or an asynchronous iterable.
+
+        """
+        if hasattr(urls, '__aiter__'):
+            aiterator = urls.__aiter__()
+            seq = 0
+            while True:
+                try:
+                    url = yield from asyncio.async(aiterator.__anext__(),
+                                                   loop=self.loop)
+                except StopAsyncIteration:
+                    break
+                yield from self._put(seq, url)
+                seq += 1
+        else:
+            for seq, url in enumerate(urls):
+                yield from self._put(seq, url)
+
+    @asyncio.coroutine
+    def _put(self, seq, url):
+        if isinstance(url, URLStat) and url.seq is not None:
+            seq = url.seq
+        if self.journal is not None and self.journal.is_completed(seq):
+            return
+        if self.reorder_buffer is not None:
+            yield from self.reorder_buffer.expect(seq, url)
+        yield from self.q.put((seq, url))
+        self.metrics.url_in()
+
     @asyncio.coroutine
     def _clean(self):
         try:
             self.consumer = asyncio.Task(self.save_results(), loop=self.loop)
-            self.workers = [asyncio.Task(self.work(), loop=self.loop) for _ in
-                            range(self.num_workers)]
-            self.t0 = time.time()
-
-            for url in self.urls:
-                yield from self.q.put(url)
-
+            self._start()
+            yield from self._feed(self.urls)
             yield from self.q.join()
             yield from self.result_q.join()
 
@@ -245,15 +1685,141 @@ class URLCleaner:
         self.clean_task = asyncio.async(self._clean(), loop=self.loop)
         return self.clean_task
 
+    def iter_results(self, urls=None):
+        """Return asynchronous iterator of cleaned URLStats.
+
+        Results are yielded as they complete, result_saver is not used.
+        urls, an iterable or an asynchronous iterable, default to urls
+        given to the cleaner. Cleaners with a work_queue or a
+        reorder_buffer, which results must be saved through, raise
+        ValueError.
+
+        """
+        return ResultIterator(self, self.urls if urls is None else urls)
+
     def cancel(self):
-        self.consumer.cancel()
+        if self.consumer is not None:
+            self.consumer.cancel()
+        if self.scaler is not None:
+            self.scaler.cancel()
         for w in self.workers:
             w.cancel()
 
-        self.clean_task.cancel()
+        if self.clean_task is not None:
+            self.clean_task.cancel()
+
+
+class ResultIterator:
+    """Asynchronous iterator of URLCleaner results.
+
+    Memory is bounded by the cleaner queues: while results aren't
+    consumed workers wait on the full result queue and urls aren't read
+    from their source. On Python 3.5+ it is used with async for, otherwise
+    call next() until it returns None.
+
+    """
+    def __init__(self, urlcleaner, urls):
+        if (urlcleaner.work_queue is not None or
+                urlcleaner.reorder_buffer is not None):
+            raise ValueError('Results of a cleaner with a work queue or a '
+                             'reorder buffer must be saved by it')
+        self.urlcleaner = urlcleaner
+        self.urls = urls
+        self.feeder = None
+        self.finished = False
+
+    @asyncio.coroutine
+    def _feed(self):
+        urlcleaner = self.urlcleaner
+        yield from urlcleaner._feed(self.urls)
+        yield from urlcleaner.q.join()
+        yield from urlcleaner.result_q.join()
+        yield from urlcleaner.result_q.put(None)
+
+    @asyncio.coroutine
+    def next(self):
+        """Return next cleaned URLStat or None when all are returned."""
+        if self.finished:
+            return None
+        urlcleaner = self.urlcleaner
+        if self.feeder is None:
+            urlcleaner._start()
+            self.feeder = asyncio.Task(self._feed(), loop=urlcleaner.loop)
+
+        get = asyncio.Task(urlcleaner.result_q.get(), loop=urlcleaner.loop)
+        yield from asyncio.wait([get, self.feeder], loop=urlcleaner.loop,
+                                return_when=asyncio.FIRST_COMPLETED)
+        if not get.done():
+            # feeder is done only when cancelled or urls source failed
+            get.cancel()
+            self.close()
+            return self.feeder.result()
+
+        urlstat = get.result()
+        urlcleaner.result_q.task_done()
+        if urlstat is None:
+            urlcleaner.t1 = time.time()
+            self.close()
+            return None
+
+        urlcleaner.metrics.url_out(urlstat)
+        if urlcleaner.journal is not None:
+            urlcleaner.journal.record(urlstat.seq)
+        return urlstat
+
+    def close(self):
+        """Stop cleaning, e.g. when the rest of results are not needed."""
+        if self.finished:
+            return
+        self.finished = True
+        if self.feeder is not None:
+            self.feeder.cancel()
+        self.urlcleaner.cancel()
+        self.urlcleaner.close()
+
+    def __aiter__(self):
+        return self
+
+    @asyncio.coroutine
+    def __anext__(self):
+        urlstat = yield from self.next()
+        if urlstat is None:
+            raise StopAsyncIteration
+        return urlstat
+
+
+_HTTP_SCHEMES = ('http', 'https')
+_TWITTER_HOSTS = ('twitter.com', 'www.twitter.com')
+_TWITTER_URL = 'https://twitter.com/'
+_LINKEDIN_URL = 'https://www.linkedin.com/in/'
+
+# Fast paths for the most common url shapes, results are the same as of
+# urlparse based normalization. Scheme and host are checked by the caller
+# to keep the nickname case sensitive.
+# http://twitter.com/@nickname, http://@nickname, @nickname
+_TWITTER_FAST_RE = re.compile(
+    r'(?:([A-Za-z]+)://(?:([A-Za-z0-9.-]+)/)?)?@?(\w+)', re.ASCII)
+# http://ar.linkedin.com/in/nickname/
+_LINKEDIN_FAST_RE = re.compile(
+    r'([A-Za-z]+)://([A-Za-z0-9.-]+)/in/@?([\w.%-]+)/?', re.ASCII)
+
+_FRAGMENT_NICKNAME_RE = re.compile(r'!/?([\w\-\.%]+)')
+_TWITTER_NICKNAME_RE = re.compile(r'\w+', re.ASCII)
+_LINKEDIN_NICKNAME_RE = re.compile(r'[\w%\.-]+', re.ASCII)
+_LINKEDIN_PROFILE_PATH_RE = re.compile(r'(?:/profile/)')
+_LINKEDIN_PUB_PATH_RE = re.compile(r'(?:/pub/)?([\w\.%\-]+)')
+_LINKEDIN_PATH_NICKNAME_RE = re.compile(
+    r'/(?:in/)?(?:@?([\w\.%\-]+))', re.ASCII)
 
 
 def twitter_normalizer(url): # noqa
+    match = _TWITTER_FAST_RE.fullmatch(url) if isinstance(url, str) else None
+    if match:
+        scheme, netloc, nickname = match.groups()
+        if ((scheme is None or scheme.lower() in _HTTP_SCHEMES) and
+                (netloc is None or netloc.lower() in _TWITTER_HOSTS)):
+            return _TWITTER_URL + nickname
+
     scheme, netloc, path, _, _, fragment = urlparse(url)
     if scheme.lower() not in ('http', 'https', ''):
         logger.debug('Invalid scheme %s, url %s', scheme, url)
@@ -263,7 +1829,7 @@ def twitter_normalizer(url): # noqa
         # can't process short urls locally
         return url
 
-    if netloc.lower() not in ('twitter.com', 'www.twitter.com', ''):
+    if netloc and netloc.lower() not in _TWITTER_HOSTS:
         return _url_for_unusual_twitter_loc(url, netloc, path)
 
     nickname = _nickname_from_path(path)
@@ -274,7 +1840,7 @@ def twitter_normalizer(url): # noqa
 
     if fragment:
         # we have url like http://twitter.com/#!/nickname
-        fragment_nickname_match = re.match(r'!/?([\w\-\.%]+)', fragment)
+        fragment_nickname_match = _FRAGMENT_NICKNAME_RE.match(fragment)
         if fragment_nickname_match:
             nickname = fragment_nickname_match.group(1)
             return _twitter_url_from_nickname(nickname)
@@ -287,8 +1853,15 @@ def twitter_normalizer(url): # noqa
 
 
 def linkedin_normalizer(url): # noqa
+    match = _LINKEDIN_FAST_RE.fullmatch(url) if isinstance(url, str) else None
+    if match:
+        scheme, netloc, nickname = match.groups()
+        if (scheme.lower() in _HTTP_SCHEMES and
+                netloc.lower().endswith('linkedin.com')):
+            return _LINKEDIN_URL + nickname
+
     scheme, netloc, path, _, _, fragment = urlparse(url)
-    if scheme.lower() not in ('http', 'https'):
+    if scheme.lower() not in _HTTP_SCHEMES:
         logger.debug('Invalid scheme %s, url %s', scheme, url)
         return False
 
@@ -305,19 +1878,17 @@ def linkedin_normalizer(url): # noqa
             logger.debug('Invalid netloc %s, url %s', netloc, url)
             return False
 
-    if re.match(r'(?:/profile/)', path):
+    if _LINKEDIN_PROFILE_PATH_RE.match(path):
         # https://www.linkedin.com/profile/... urls require authentication
         # won't clean it
         return None
 
-    if re.match(r'(?:/pub/)?([\w\.%\-]+)', path):
+    if _LINKEDIN_PUB_PATH_RE.match(path):
         # https://www.linkedin.com/pub/... urls should be cleaned remotely
         # won't clean it
-        return urlunparse(
-            ('https', 'www.linkedin.com', path, '', '', ''))
+        return 'https://www.linkedin.com' + path
 
-    path_nickname_match = re.match(
-        r'/(?:in/)?(?:@?([\w\.%\-]+))', path, re.ASCII)
+    path_nickname_match = _LINKEDIN_PATH_NICKNAME_RE.match(path)
     nickname = path_nickname_match.group(1) if path_nickname_match else None
 
     if nickname:
@@ -329,7 +1900,7 @@ def linkedin_normalizer(url): # noqa
 
     if fragment:
         # we have url like http://linkedin.com/#!/nickname
-        fragment_nickname_match = re.match(r'!/?([\w\-\.%]+)', fragment)
+        fragment_nickname_match = _FRAGMENT_NICKNAME_RE.match(fragment)
         if fragment_nickname_match:
             nickname = fragment_nickname_match.group(1)
             return _linkedin_url_from_nickname(nickname)
@@ -356,18 +1927,16 @@ def _url_for_unusual_twitter_loc(url, netloc, path):
 
 
 def _twitter_url_from_nickname(nickname):
-    if re.fullmatch(r'\w+', nickname, re.ASCII):
-        return urlunparse(
-            ('https', 'twitter.com', nickname, '', '', ''))
+    if _TWITTER_NICKNAME_RE.fullmatch(nickname):
+        return _TWITTER_URL + nickname
     else:
         logger.debug('Invalid nickname %s', nickname)
         return False
 
 
 def _linkedin_url_from_nickname(nickname):
-    if re.fullmatch(r'[\w%\.-]+', nickname, re.ASCII):
-        return urlunparse(
-            ('https', 'www.linkedin.com', 'in/' + nickname, '', '', ''))
+    if _LINKEDIN_NICKNAME_RE.fullmatch(nickname):
+        return _LINKEDIN_URL + nickname
     else:
         logger.debug('Invalid nickname %s', nickname)
         return False
@@ -384,3 +1953,169 @@ def _nickname_from_path(path):
         nickname = nickname[1:]
 
     return nickname
+
+
+NORMALIZERS = OrderedDict()
+_SERVICE_HOSTS = {}
+# host of absolute and scheme relative urls
+_HOST_RE = re.compile(r'(?:[A-Za-z][A-Za-z0-9+.-]*:)?//(?:[^/?#@]*@)?'
+                      r'([^/?#:]*)')
+
+
+def register_normalizer(service, normalizer, hosts=()):
+    """Register normalizer of service urls.
+
+    hosts are domains of service urls, their subdomains are matched too.
+    Hosts shared by services, like bit.ly, should not be registered.
+
+    """
+    NORMALIZERS[service] = normalizer
+    for host in hosts:
+        _SERVICE_HOSTS[host.lower()] = service
+
+
+def get_normalizer(service):
+    """Return normalizer of service, 'all' returns Dispatcher of all."""
+    if service == 'all':
+        return Dispatcher()
+    return NORMALIZERS[service]
+
+
+class Dispatcher:
+    """Normalizer passing urls to normalizers of their services.
+
+    Service of url is looked up by its host, then by parent domains of the
+    host. Urls without host or with unknown one go to default service, the
+    first one by default.
+
+    """
+    def __init__(self, services=None, default=None, maxsize=100000):
+        self.normalizers = OrderedDict(
+            (service, NORMALIZERS[service]) for service in
+            (services or NORMALIZERS))
+        self.default = default or next(iter(self.normalizers))
+        self.maxsize = maxsize
+        self._hosts = {host: service for host, service in
+                       _SERVICE_HOSTS.items() if service in self.normalizers}
+        # remembered services of subdomains and unknown hosts too
+        self._services = dict(self._hosts)
+
+    def service(self, url):
+        match = _HOST_RE.match(url) if isinstance(url, str) else None
+        if match is None:
+            return self.default
+
+        host = match.group(1)
+        service = self._services.get(host)
+        if service is None:
+            # remembered as written, most hosts are lowercase already
+            service = self._find(host.lower())
+            if len(self._services) < self.maxsize:
+                self._services[host] = service
+        return service
+
+    def _find(self, host):
+        service = self._hosts.get(host)
+        if service is not None:
+            return service
+        while '.' in host:
+            host = host.partition('.')[2]
+            service = self._hosts.get(host)
+            if service is not None:
+                return service
+        return self.default
+
+    def __call__(self, url):
+        return self.normalizers[self.service(url)](url)
+
+
+class MemoizedNormalizer:
+    """LRU memoization of a normalizer keyed on raw url strings.
+
+    Results missing in memory are looked up in optional index, an
+    urlindex.URLIndex written by save() in a previous run, so it must be
+    rebuilt when normalizers change. Non-string urls aren't memoized.
+
+    """
+    # http codes of index values marking False and None results
+    _INVALID = 1
+    _UNCLEANABLE = 2
+
+    def __init__(self, normalizer, maxsize=100000, index=None):
+        self.normalizer = normalizer
+        self.maxsize = maxsize
+        self.index = index
+        self._results = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.index_hits = 0
+
+    def __call__(self, url):
+        if not isinstance(url, str):
+            return self.normalizer(url)
+
+        try:
+            result = self._results[url]
+        except KeyError:
+            pass
+        else:
+            self._results.move_to_end(url)
+            self.hits += 1
+            return result
+
+        self.misses += 1
+        result = self._load(url)
+        self._results[url] = result
+        if len(self._results) > self.maxsize:
+            self._results.popitem(last=False)
+        return result
+
+    def _load(self, url):
+        if self.index is not None:
+            entry = self.index.get(url)
+            if entry is not None:
+                self.index_hits += 1
+                code, normalized = entry
+                if code == self._INVALID:
+                    return False
+                if code == self._UNCLEANABLE:
+                    return None
+                return normalized
+        return self.normalizer(url)
+
+    def save(self, path, false_positive_rate=0.01):
+        """Write memoized results and those of index to index file at path.
+
+        The file is replaced, so index may be the one read from path.
+
+        """
+        entries = {}
+        if self.index is not None:
+            # results of previous runs not used in this one are kept too
+            entries.update(self.index.items())
+        for url, result in self._results.items():
+            if result is False:
+                entries[url] = (self._INVALID, '')
+            elif result is None:
+                entries[url] = (self._UNCLEANABLE, '')
+            else:
+                entries[url] = (None, result)
+        write_index(path + '.tmp', entries, false_positive_rate)
+        os.replace(path + '.tmp', path)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._results),
+            'hits': self.hits,
+            'misses': self.misses,
+            'index_hits': self.index_hits,
+            'hit_rate': round(self.hits / lookups, 3) if lookups else None,
+        }
+
+
+register_normalizer('twitter', twitter_normalizer,
+                    hosts=('twitter.com', 't.com'))
+register_normalizer('linkedin', linkedin_normalizer,
+                    hosts=('linkedin.com', 'lnkd.in'))
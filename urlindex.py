@@ -0,0 +1,196 @@
+# coding: utf-8
+
+"""Compact indexes of known urls, memory mapped at startup.
+
+An index file holds a Bloom filter, a sorted array of 64 bit url
+hashes and the urls themselves, optionally with a value for every url.
+The Bloom filter answers most misses without touching the array, hits
+are found by binary search in it and confirmed by comparing the url, so
+lookups are exact.
+
+File layout, in native byte order:
+
+    magic, byte order, 8 bytes
+    number of urls, Bloom filter bits, number of hashes, has values, 4 Q
+    Bloom filter, bits / 8 bytes, padded to 8 bytes
+    sorted url hashes, Q per url
+    offsets of entries in the blob, Q per url, and the blob of entries,
+    each is I url length, H http code, H value length and utf-8 url and
+    value strings, the value is empty without values
+
+"""
+
+import bisect
+import hashlib
+import math
+import mmap
+import struct
+import sys
+
+MAGIC = b'URLIDX2' + (b'L' if sys.byteorder == 'little' else b'B')
+_HEADER = struct.Struct('=4Q')
+_ENTRY = struct.Struct('=I2H')
+
+
+class InvalidIndex(Exception):
+    pass
+
+
+def url_hashes(url):
+    """Return two 64 bit hashes of url."""
+    return struct.unpack('=2Q', hashlib.md5(url.encode('utf-8')).digest())
+
+
+def bloom_size(count, false_positive_rate):
+    """Return bits and number of hashes of Bloom filter for count urls."""
+    count = max(count, 1)
+    bits = -count * math.log(false_positive_rate) / math.log(2) ** 2
+    bits = max(64, int(math.ceil(bits / 64)) * 64)
+    num_hashes = max(1, int(round(bits / count * math.log(2))))
+    return bits, num_hashes
+
+
+def _bloom_positions(first, second, bits, num_hashes):
+    return [(first + i * second) % bits for i in range(num_hashes)]
+
+
+def write_index(path, urls, false_positive_rate=0.01):
+    """Write index of urls to path.
+
+    urls is an iterable of urls or a dict mapping urls to (http_code,
+    string) values.
+
+    """
+    has_values = isinstance(urls, dict)
+    entries = []
+    for url in set(urls):
+        first, second = url_hashes(url)
+        entries.append((first, url, second))
+    # urls with colliding hashes are next to each other
+    entries.sort()
+
+    bits, num_hashes = bloom_size(len(entries), false_positive_rate)
+    bloom = bytearray(bits // 8)
+    for first, _, second in entries:
+        for position in _bloom_positions(first, second, bits, num_hashes):
+            bloom[position >> 3] |= 1 << (position & 7)
+
+    blob = bytearray()
+    offsets = []
+    for _, url, _ in entries:
+        http_code, value = urls[url] if has_values else (None, '')
+        url, value = url.encode('utf-8'), value.encode('utf-8')
+        offsets.append(len(blob))
+        blob += _ENTRY.pack(len(url), http_code or 0, len(value))
+        blob += url
+        blob += value
+
+    with open(path, 'wb') as ioobj:
+        ioobj.write(MAGIC)
+        ioobj.write(_HEADER.pack(len(entries), bits, num_hashes, has_values))
+        ioobj.write(bloom)
+        ioobj.write(struct.pack('={}Q'.format(len(entries)),
+                                *[first for first, _, _ in entries]))
+        ioobj.write(struct.pack('={}Q'.format(len(offsets)), *offsets))
+        ioobj.write(blob)
+
+
+class URLIndex:
+    """Memory mapped index of urls written by write_index."""
+
+    def __init__(self, path):
+        self.path = path
+        self.hits = 0
+        self.lookups = 0
+        with open(path, 'rb') as ioobj:
+            self._mmap = mmap.mmap(ioobj.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self._mmap[:len(MAGIC)] != MAGIC:
+            self._mmap.close()
+            raise InvalidIndex(
+                '{} is not an url index of this platform'.format(path))
+
+        offset = len(MAGIC)
+        (self.count, self.bits, self.num_hashes,
+         self.has_values) = _HEADER.unpack_from(self._mmap, offset)
+        offset += _HEADER.size
+
+        self._view = view = memoryview(self._mmap)
+        self._bloom = view[offset:offset + self.bits // 8]
+        offset += self.bits // 8
+        self._hashes = view[offset:offset + self.count * 8].cast('Q')
+        offset += self.count * 8
+        self._offsets = view[offset:offset + self.count * 8].cast('Q')
+        self._blob = offset + self.count * 8
+
+    def __len__(self):
+        return self.count
+
+    def _find(self, url):
+        """Return position of url hash in the index or -1."""
+        first, second = url_hashes(url)
+        bloom = self._bloom
+        for position in _bloom_positions(first, second, self.bits,
+                                         self.num_hashes):
+            if not bloom[position >> 3] & (1 << (position & 7)):
+                return -1
+
+        encoded = url.encode('utf-8')
+        index = bisect.bisect_left(self._hashes, first)
+        while index < self.count and self._hashes[index] == first:
+            offset = self._blob + self._offsets[index]
+            length, _, _ = _ENTRY.unpack_from(self._mmap, offset)
+            offset += _ENTRY.size
+            if self._mmap[offset:offset + length] == encoded:
+                return index
+            index += 1
+        return -1
+
+    def __contains__(self, url):
+        return self._find(url) >= 0
+
+    def get(self, url):
+        """Return (http_code, value) of url or None."""
+        self.lookups += 1
+        index = self._find(url)
+        if index < 0:
+            return None
+        self.hits += 1
+        if not self.has_values:
+            return (None, None)
+
+        offset = self._blob + self._offsets[index]
+        url_length, http_code, length = _ENTRY.unpack_from(self._mmap,
+                                                           offset)
+        offset += _ENTRY.size + url_length
+        value = self._mmap[offset:offset + length].decode('utf-8')
+        return http_code or None, value
+
+    def items(self):
+        """Yield (url, (http_code, value)) of all urls in the index."""
+        for index in range(self.count):
+            offset = self._blob + self._offsets[index]
+            url_length, http_code, length = _ENTRY.unpack_from(self._mmap,
+                                                               offset)
+            offset += _ENTRY.size
+            url = self._mmap[offset:offset + url_length].decode('utf-8')
+            offset += url_length
+            if self.has_values:
+                value = self._mmap[offset:offset + length].decode('utf-8')
+                yield url, (http_code or None, value)
+            else:
+                yield url, (None, None)
+
+    def stats(self):
+        return {
+            'urls': self.count,
+            'lookups': self.lookups,
+            'hits': self.hits,
+        }
+
+    def close(self):
+        self._bloom.release()
+        self._hashes.release()
+        self._offsets.release()
+        self._view.release()
+        self._mmap.close()
@@ -0,0 +1,291 @@
+# coding: utf-8
+
+"""Durable work queues shared by URLCleaner runs on several nodes.
+
+A job is a set of tasks, input urls identified by their sequence number
+in the input. Nodes lease batches of tasks, clean them and acknowledge
+results. A lease is visible only to its owner for visibility_timeout
+seconds, tasks of lost nodes are leased again when their leases expire.
+Tasks leased max_tries times without acknowledgement are dead-lettered,
+so are tasks failed max_tries times, e.g. on remote errors.
+
+WorkQueue describes the protocol of queue backends, SQLiteWorkQueue is
+the one runnable locally.
+
+"""
+
+import asyncio
+import logging
+import os
+import socket
+import sqlite3
+import time
+
+from urlcleaner import URLStat, StopAsyncIteration, local_clean
+
+logger = logging.getLogger(__name__)
+
+
+class WorkQueue:
+    """Protocol of work queue backends.
+
+    Tasks are (task_id, url) pairs. Delivery is at least once: results of
+    a node lost before acknowledging them are cleaned again by others.
+
+    """
+    def put_many(self, tasks):
+        """Add tasks, ids already known to the queue are ignored.
+
+        So every node may seed the queue with the same input.
+
+        """
+        raise NotImplementedError
+
+    def lease(self, count):
+        """Return up to count pending tasks leased by this node."""
+        raise NotImplementedError
+
+    def renew(self):
+        """Extend leases of all tasks leased by this node."""
+        raise NotImplementedError
+
+    def ack(self, task_id, urlstat):
+        """Complete leased task with its result."""
+        raise NotImplementedError
+
+    def fail(self, task_id, error):
+        """Give up leased task, it is retried or dead-lettered."""
+        raise NotImplementedError
+
+    def finished(self):
+        """Return True when no task is pending or leased.
+
+        Tasks leased by this node may still fail and be pending again.
+
+        """
+        raise NotImplementedError
+
+    def results(self):
+        """Yield URLStats of completed tasks."""
+        raise NotImplementedError
+
+    def dead_letters(self):
+        """Yield (task_id, url, tries, error) of dead-lettered tasks."""
+        raise NotImplementedError
+
+    def stats(self):
+        raise NotImplementedError
+
+    def close(self):
+        """Write pending acknowledgements and release leases."""
+        raise NotImplementedError
+
+
+def default_owner():
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+class SQLiteWorkQueue(WorkQueue):
+    """WorkQueue in SQLite database.
+
+    Nodes share the database file, so they must run on one host or on a
+    file system with working locks. Acknowledgements are written in
+    batches of commit_every, on every lease and renewal, so that write
+    locks are held only briefly.
+
+    """
+    def __init__(self, path, max_tries=3, visibility_timeout=300.0, *,
+                 owner=None, commit_every=100, clock=time.time):
+        self.path = path
+        self.max_tries = max_tries
+        self.visibility_timeout = visibility_timeout
+        self.owner = owner or default_owner()
+        self.commit_every = commit_every
+        self.clock = clock
+        self.leased = set()
+        self._acks = []
+        self.acked = 0
+        self.failed = 0
+        self.expired = 0
+
+        # transactions are begun explicitly to lock the database on reads
+        self.db = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS tasks ('
+            'id INTEGER PRIMARY KEY, url TEXT, state TEXT, '
+            'tries INTEGER DEFAULT 0, owner TEXT, lease_expires REAL, '
+            'error TEXT, status TEXT, local_clean_url TEXT, '
+            'remote_clean_url TEXT, http_code INTEGER, exception TEXT, '
+            'retries INTEGER)')
+        self.db.execute(
+            'CREATE INDEX IF NOT EXISTS tasks_state ON tasks (state, id)')
+
+    def put_many(self, tasks):
+        with self.db:
+            self.db.execute('BEGIN IMMEDIATE')
+            self.db.executemany(
+                "INSERT OR IGNORE INTO tasks (id, url, state) "
+                "VALUES (?, ?, 'pending')", tasks)
+
+    def lease(self, count):
+        now = self.clock()
+        with self.db:
+            self.db.execute('BEGIN IMMEDIATE')
+            self._write_acks()
+            cursor = self.db.execute(
+                "UPDATE tasks SET state = 'dead', owner = NULL, "
+                "error = 'lease expired' WHERE state = 'leased' AND "
+                "lease_expires <= ? AND tries >= ?", (now, self.max_tries))
+            if cursor.rowcount > 0:
+                logger.warning('Dead-lettered %d urls with expired leases',
+                               cursor.rowcount)
+                self.expired += cursor.rowcount
+            tasks = self.db.execute(
+                "SELECT id, url FROM tasks WHERE state = 'pending' OR "
+                "(state = 'leased' AND lease_expires <= ?) ORDER BY id "
+                "LIMIT ?", (now, count)).fetchall()
+            self.db.executemany(
+                "UPDATE tasks SET state = 'leased', owner = ?, "
+                "tries = tries + 1, lease_expires = ? WHERE id = ?",
+                [(self.owner, now + self.visibility_timeout, task_id) for
+                 task_id, _ in tasks])
+        self.leased.update(task_id for task_id, _ in tasks)
+        return tasks
+
+    def renew(self):
+        with self.db:
+            self.db.execute('BEGIN IMMEDIATE')
+            self._write_acks()
+            self.db.execute(
+                "UPDATE tasks SET lease_expires = ? WHERE owner = ? AND "
+                "state = 'leased'",
+                (self.clock() + self.visibility_timeout, self.owner))
+
+    def ack(self, task_id, urlstat):
+        self.leased.discard(task_id)
+        self._acks.append((
+            str(urlstat.status), urlstat.local_clean_url,
+            urlstat.remote_clean_url, urlstat.http_code,
+            None if urlstat.exception is None else str(urlstat.exception),
+            urlstat.retries, task_id))
+        self.acked += 1
+        if len(self._acks) >= self.commit_every:
+            self.flush()
+
+    def _write_acks(self):
+        # results of tasks taken over by other nodes are accepted too
+        self.db.executemany(
+            "UPDATE tasks SET state = 'done', owner = NULL, status = ?, "
+            "local_clean_url = ?, remote_clean_url = ?, http_code = ?, "
+            "exception = ?, retries = ? WHERE id = ?", self._acks)
+        self._acks = []
+
+    def flush(self):
+        with self.db:
+            self.db.execute('BEGIN IMMEDIATE')
+            self._write_acks()
+
+    def fail(self, task_id, error):
+        self.leased.discard(task_id)
+        self.failed += 1
+        with self.db:
+            self.db.execute('BEGIN IMMEDIATE')
+            self.db.execute(
+                "UPDATE tasks SET state = CASE WHEN tries >= ? THEN 'dead' "
+                "ELSE 'pending' END, owner = NULL, error = ? WHERE id = ? "
+                "AND owner = ? AND state = 'leased'",
+                (self.max_tries, error, task_id, self.owner))
+
+    def finished(self):
+        if self._acks:
+            self.flush()
+        unfinished, = self.db.execute(
+            "SELECT COUNT(*) FROM tasks WHERE state = 'pending' OR "
+            "state = 'leased'").fetchone()
+        return not unfinished
+
+    def results(self):
+        for row in self.db.execute(
+                "SELECT id, url, status, local_clean_url, remote_clean_url, "
+                "http_code, exception, retries FROM tasks "
+                "WHERE state = 'done' ORDER BY id"):
+            (seq, url, status, local_clean_url, remote_clean_url, http_code,
+             exception, retries) = row
+            yield URLStat(url=url, local_clean_url=local_clean_url,
+                          remote_clean_url=remote_clean_url, status=status,
+                          http_code=http_code, exception=exception,
+                          retries=retries, seq=seq)
+
+    def dead_letters(self):
+        return self.db.execute(
+            "SELECT id, url, tries, error FROM tasks WHERE state = 'dead' "
+            "ORDER BY id")
+
+    def stats(self):
+        stats = {'pending': 0, 'leased': 0, 'done': 0, 'dead': 0}
+        stats.update(self.db.execute(
+            'SELECT state, COUNT(*) FROM tasks GROUP BY state'))
+        stats.update({
+            'in_flight': len(self.leased),
+            'acked': self.acked,
+            'failed': self.failed,
+            'expired': self.expired,
+        })
+        return stats
+
+    def close(self):
+        """Write acknowledgements and return unfinished leases."""
+        with self.db:
+            self.db.execute('BEGIN IMMEDIATE')
+            self._write_acks()
+            # leases given up by a clean shutdown don't count as tries
+            self.db.execute(
+                "UPDATE tasks SET state = 'pending', owner = NULL, "
+                "tries = tries - 1 WHERE owner = ? AND state = 'leased'",
+                (self.owner,))
+        self.db.close()
+
+
+class LeasedURLs:
+    """Asynchronous iterable of URLStats leased from work_queue.
+
+    Urls are locally cleaned with normalizer, their seq is the task id.
+    Leases are renewed every third of visibility timeout, iteration ends
+    when the job is finished.
+
+    """
+    def __init__(self, work_queue, normalizer, batch_size=100,
+                 poll_interval=1.0, *, loop=None):
+        self.work_queue = work_queue
+        self.normalizer = normalizer
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.loop = loop or asyncio.get_event_loop()
+        self.tasks = []
+        self.loop.call_later(work_queue.visibility_timeout / 3,
+                             self._renew_periodically)
+
+    def __aiter__(self):
+        return self
+
+    @asyncio.coroutine
+    def __anext__(self):
+        while not self.tasks:
+            self.tasks = self.work_queue.lease(self.batch_size)
+            self.tasks.reverse()
+            if self.tasks:
+                break
+            if self.work_queue.finished():
+                raise StopAsyncIteration
+            # wait for leases of other nodes to be acknowledged or expire
+            yield from asyncio.sleep(self.poll_interval, loop=self.loop)
+
+        task_id, url = self.tasks.pop()
+        urlstat = local_clean(url, self.normalizer)
+        urlstat.seq = task_id
+        return urlstat
+
+    def _renew_periodically(self):
+        self.work_queue.renew()
+        self.loop.call_later(self.work_queue.visibility_timeout / 3,
+                             self._renew_periodically)